@@ -0,0 +1,199 @@
+# -*- coding: UTF-8 -*-
+
+import os
+import shutil
+import numpy as np
+
+from helpers.UserItemIndex import UserItemIndex
+
+
+class InteractionStore(object):
+    """
+    Single binary file holding the (user_id, item_id) interactions in columnar form:
+    a fixed-size header followed by the int32 user column and the int32 item column.
+    The file is written once sequentially and memory-mapped read-only on access,
+    so a mini-batch is a zero-copy slice of the two columns.
+    Each column has room for `capacity` rows, so that new interactions are appended in place
+    (the file is rewritten with a larger capacity only when it is full).
+    """
+    MAGIC = b'FADEIS02'
+    HEADER_SIZE = 64
+    GROWTH = 1.5
+    dtype = np.int32
+
+    def __init__(self, path):
+        self.path = path
+        self._read_header()
+        self._users = None
+        self._items = None
+
+    def _read_header(self):
+        with open(self.path, 'rb') as f:
+            header = f.read(self.HEADER_SIZE)
+        if header[:len(self.MAGIC)] != self.MAGIC:
+            raise ValueError('Not an interaction store: {}'.format(self.path))
+        fields = np.frombuffer(header, dtype=np.int64, count=2, offset=len(self.MAGIC))
+        self.n_rows = int(fields[0])
+        self.capacity = int(fields[1])
+
+    @classmethod
+    def _header(cls, n_rows, capacity):
+        header = np.zeros(cls.HEADER_SIZE, dtype=np.uint8)
+        header[:len(cls.MAGIC)] = np.frombuffer(cls.MAGIC, dtype=np.uint8)
+        header[len(cls.MAGIC):len(cls.MAGIC)+16] = np.array([n_rows, capacity], dtype=np.int64).view(np.uint8)
+        return header
+
+    @classmethod
+    def write(cls, path, users, items, capacity=None):
+        users = np.ascontiguousarray(users, dtype=cls.dtype)
+        items = np.ascontiguousarray(items, dtype=cls.dtype)
+        assert len(users) == len(items), 'User and item columns differ in length'
+        capacity = int(len(users) * cls.GROWTH) if capacity is None else max(capacity, len(users))
+
+        itemsize = np.dtype(cls.dtype).itemsize
+        with open(path, 'wb') as f:
+            cls._header(len(users), capacity).tofile(f)
+            users.tofile(f)
+            f.seek(cls.HEADER_SIZE + capacity * itemsize)
+            items.tofile(f)
+            f.truncate(cls.HEADER_SIZE + 2 * capacity * itemsize)
+        return cls(path)
+
+    @classmethod
+    def write_chunks(cls, path, chunks):
+        """
+        Write the store from an iterable of (users, items) chunks without holding all rows in memory:
+        the user column is streamed into the file and the item column into a side file, which is copied
+        behind the user column (and its free capacity) once the number of rows is known.
+        """
+        itemsize = np.dtype(cls.dtype).itemsize
+        items_path = path + '.items'
+        n_rows = 0
+        with open(path, 'wb') as f, open(items_path, 'wb') as f_items:
+            f.seek(cls.HEADER_SIZE)
+            for users, items in chunks:
+                users = np.ascontiguousarray(users, dtype=cls.dtype)
+                items = np.ascontiguousarray(items, dtype=cls.dtype)
+                assert len(users) == len(items), 'User and item columns differ in length'
+                users.tofile(f)
+                items.tofile(f_items)
+                n_rows += len(users)
+        capacity = int(n_rows * cls.GROWTH)
+        with open(path, 'r+b') as f, open(items_path, 'rb') as f_items:
+            f.seek(cls.HEADER_SIZE + capacity * itemsize)
+            shutil.copyfileobj(f_items, f)
+            f.truncate(cls.HEADER_SIZE + 2 * capacity * itemsize)
+            f.seek(0)
+            cls._header(n_rows, capacity).tofile(f)
+        os.remove(items_path)
+        return cls(path)
+
+    def append(self, users, items):
+        # New rows go into the free capacity and the row count in the header is updated last;
+        # a full store is rewritten (to a new file, replacing the old one) with a larger capacity
+        users = np.ascontiguousarray(users, dtype=self.dtype)
+        items = np.ascontiguousarray(items, dtype=self.dtype)
+        assert len(users) == len(items), 'User and item columns differ in length'
+        n_rows = self.n_rows + len(users)
+
+        if n_rows > self.capacity:
+            tmp_path = self.path + '.tmp'
+            capacity = max(n_rows, int(self.capacity * self.GROWTH))
+            self.write(tmp_path, np.concatenate([self.users, users]), np.concatenate([self.items, items]), capacity)
+            os.replace(tmp_path, self.path)
+        else:
+            itemsize = np.dtype(self.dtype).itemsize
+            with open(self.path, 'r+b') as f:
+                for col, values in enumerate([users, items]):
+                    f.seek(self.HEADER_SIZE + (col * self.capacity + self.n_rows) * itemsize)
+                    values.tofile(f)
+                f.flush()
+                f.seek(0)
+                self._header(n_rows, self.capacity).tofile(f)
+
+        self._read_header()
+        self._users = None
+        self._items = None
+
+    def _column(self, col):
+        if self.n_rows == 0:
+            return np.zeros(0, dtype=self.dtype)
+        offset = self.HEADER_SIZE + col * self.capacity * np.dtype(self.dtype).itemsize
+        return np.memmap(self.path, dtype=self.dtype, mode='r', offset=offset, shape=(self.n_rows,))
+
+    @property
+    def users(self):
+        if self._users is None:
+            self._users = self._column(0)
+        return self._users
+
+    @property
+    def items(self):
+        if self._items is None:
+            self._items = self._column(1)
+        return self._items
+
+    def view(self, ranges, n_users, index=None):
+        return SnapshotView(self, ranges, n_users, index)
+
+    def __len__(self):
+        return self.n_rows
+
+    def __getstate__(self):
+        # Memory maps are re-opened lazily in the receiving process (e.g., DataLoader workers)
+        state = self.__dict__.copy()
+        state['_users'] = None
+        state['_items'] = None
+        return state
+
+
+class SnapshotView(object):
+    """
+    Interactions in the given (start, end) row ranges of an interaction store.
+    Derived arrays (unique users/items, per-user counts, user-item index) are computed on first use and kept.
+    """
+    def __init__(self, store, ranges, n_users, index=None):
+        self.store = store
+        self.ranges = tuple(ranges)
+        self.n_users = n_users
+        self._index = index
+        self._columns = None
+        self._users = None
+        self._items = None
+        self._n_pos = None
+
+    @property
+    def columns(self):
+        # Zero-copy slices of the store for a single range
+        if self._columns is None and len(self.ranges) == 1:
+            start, end = self.ranges[0]
+            self._columns = (self.store.users[start:end], self.store.items[start:end])
+        elif self._columns is None:
+            self._columns = (np.concatenate([self.store.users[start:end] for start, end in self.ranges]),
+                             np.concatenate([self.store.items[start:end] for start, end in self.ranges]))
+        return self._columns
+
+    @property
+    def users(self):
+        if self._users is None:
+            self._users = np.unique(self.columns[0])
+        return self._users
+
+    @property
+    def items(self):
+        if self._items is None:
+            self._items = np.unique(self.columns[1])
+        return self._items
+
+    @property
+    def n_pos(self):
+        # The number of interactions of each user (including repeated ones)
+        if self._n_pos is None:
+            self._n_pos = np.bincount(self.columns[0], minlength=self.n_users)
+        return self._n_pos
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = UserItemIndex.build(self.columns[0], self.columns[1], self.n_users)
+        return self._index
@@ -2,15 +2,16 @@
 
 import os
 import time
-import pickle
+import json
 import logging
 import math
-import torch
-from random import randint
+import hashlib
+import bisect
 import pandas as pd
 import numpy as np
-import datetime
 from utils import utils
+from helpers.InteractionStore import InteractionStore
+from helpers.UserItemIndex import UserItemIndex
 
 
 class Reader(object):
@@ -34,6 +35,12 @@ class Reader(object):
                             help='Number of test snapshots')
         parser.add_argument('--split_type', type=str, default='size',
                             help='Data split type')
+        parser.add_argument('--export_snapshots', type=int, default=0,
+                            help='Whether to export the train/test text files of snapshots.')
+        parser.add_argument('--append_file', type=str, default='',
+                            help='CSV file of new interactions appended to the saved corpus as a new snapshot (a file already appended is skipped).')
+        parser.add_argument('--read_chunksize', type=int, default=1000000,
+                            help='Number of csv rows read at a time when ingesting interactions.')
 
 
         return parser
@@ -51,34 +58,31 @@ class Reader(object):
         self.random_seed = args.random_seed
         self.n_snapshots = args.n_snapshots 
         self.split_type = args.split_type
+        self.read_chunksize = args.read_chunksize
+        self._interactions = None
+        self.appended_files = []  # content digests of the files appended to the corpus
 
         t0 = time.time()
-        self._read_data()
-        #print(self.data_df['user_id'].max(),len(self.data_df['user_id'].unique()))
-        #print(self.data_df['item_id'].max(),len(self.data_df['item_id'].unique()))
-
-        #logging.info('Counting dataset statistics...')
-        self.n_users, self.n_items = self.data_df['user_id'].max()+1, self.data_df['item_id'].max()+1
-        self.dataset_size = len(self.data_df)
-        self.n_batches = math.ceil(self.dataset_size/self.batch_size)
-        logging.info('"# user": {}, "# item": {}, "# entry": {}'.format(self.n_users, self.n_items, self.dataset_size))
         path = os.path.join(self.prefix, self.dataset, self.suffix, self.s_fname)
         if not os.path.exists(path):
             os.mkdir(path)
         del path
 
-        self._set_snap_boundaries()
-        self._save_snapshot_files()
+        # The csv is streamed into the interaction store, which also gives the dataset statistics
+        self._read_data()
+        # First row and first batch of each block of interactions (the initial data, then every appended file);
+        # a batch never spans two blocks, so that an appended block starts a new batch
+        self.block_rows = [0]
+        self.block_batches = [0]
+        self.n_batches = math.ceil(self.dataset_size/self.batch_size)
+        logging.info('"# user": {}, "# item": {}, "# entry": {}'.format(self.n_users, self.n_items, self.dataset_size))
 
-        #logging.info('Saving data into mini-batch pickle files')
-        self.user_list = self.data_df['user_id'].to_numpy()
-        self._save_user_clicked_set()
-        self._save_mini_batch()
+        self._set_snap_boundaries()
+        self._save_snapshot_manifest()
+        self._save_user_index()
 
         self.user_attr_path = os.path.join(self.prefix, self.dataset, self.suffix, 'user_attr')
 
-        del self.df
-
         logging.info('Done! [{:<.2f} s]'.format(time.time() - t0) + os.linesep)
 
 
@@ -146,70 +150,183 @@ class Reader(object):
         #     print('snap_boundaries: {}'.format(self.snap_boundaries))
 
 
-    def _save_snapshot_files(self):
-        self.snapshots_path = os.path.join(self.prefix, self.dataset, self.suffix, self.s_fname, 'snapshots')
-        if not os.path.exists(self.snapshots_path):
-            os.mkdir(self.snapshots_path)
+    def _save_snapshot_manifest(self):
+        # Snapshots are described by row ranges over the interaction store, instead of copies of the interactions
+        self.snapshot_manifest_path = os.path.join(self.prefix, self.dataset, self.suffix, self.s_fname, 'snapshots.json')
 
-        #test_settings = ['remain', 'fixed', 'next']
+        def batch_row(n_batches):
+            return self.batch_rows(n_batches)[0] if n_batches < self.n_batches else self.dataset_size
 
+        #test_settings = ['remain', 'fixed', 'next']
+        self.snapshots = []
         for idx, snap_boundary in enumerate(self.snap_boundaries):
-            snapshot_train = self.data_df[:(self.n_train_batches + snap_boundary) * self.batch_size].values.astype(np.int64)
-
-            if idx == 0:
-                gap = 0
+            train_rows = [0, batch_row(self.n_train_batches + snap_boundary)]
+            if idx == len(self.snap_boundaries)-1:
+                next_end = self.dataset_size
             else:
-                gap = self.snap_boundaries[idx] - self.snap_boundaries[idx-1]
-            snapshot_train_new = self.data_df[(self.n_train_batches + gap) * self.batch_size:(self.n_train_batches + snap_boundary) * self.batch_size].values.astype(np.int64)
-
-            snapshot_test = self.data_df[(self.n_train_batches + snap_boundary) * self.batch_size:].values.astype(np.int64)
-            utils.write_interactions_to_file(os.path.join(self.snapshots_path, 'remain_train_snap'+str(idx)), snapshot_train)
-            utils.write_interactions_to_file(os.path.join(self.snapshots_path, 'remain_test_snap'+str(idx)), snapshot_test)
-            #utils.write_interactions_to_file(os.path.join(self.snapshots_path, 'remain_train_new_snap'+str(idx)), snapshot_train_new)
+                next_end = batch_row(self.n_train_batches + self.snap_boundaries[idx+1])
+            self.snapshots.append({
+                'remain': {'train': train_rows, 'test': [train_rows[1], self.dataset_size]},
+                'fixed': {'train': train_rows, 'test': [batch_row(self.n_train_batches + self.snap_boundaries[-1]), self.dataset_size]},
+                'next': {'train': train_rows, 'test': [train_rows[1], next_end]},
+            })
+
+        with open(self.snapshot_manifest_path, 'w') as f:
+            json.dump({'n_rows': self.dataset_size,
+                       'batch_size': self.batch_size,
+                       'block_rows': self.block_rows,
+                       'n_train_batches': self.n_train_batches,
+                       'snap_boundaries': self.snap_boundaries,
+                       'snapshots': self.snapshots}, f, indent=1)
+
+    def save(self, path):
+        # Only the metadata (counts, boundaries, paths) is saved; the snapshots are re-read from their manifest
+        # and the interaction store and user index are memory-mapped from their own files on first access
+        state = {k: v for k, v in self.__dict__.items() if k not in ('user_index', 'snapshots', '_interactions')}
+        state['user_index_path'] = self.user_index.path
+        with open(path, 'w') as f:
+            json.dump(state, f, indent=1)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as f:
+            state = json.load(f)
+        corpus = cls.__new__(cls)
+        corpus.user_index = UserItemIndex.load(state.pop('user_index_path'))
+        state.setdefault('appended_files', [])  # corpus files saved before appends were recorded
+        state.setdefault('block_rows', [0])
+        state.setdefault('block_batches', [0])
+        corpus.__dict__.update(state)
+        with open(corpus.snapshot_manifest_path, 'r') as f:
+            corpus.snapshots = json.load(f)['snapshots']
+        corpus._interactions = None
+        return corpus
+
+    @property
+    def interactions(self):
+        if self._interactions is None:
+            self._interactions = InteractionStore(self.interactions_path)
+        return self._interactions
+
+    def batch_rows(self, batch_idx):
+        # (start, end) rows of a batch: batches are counted from the first row of their block
+        block = bisect.bisect_right(self.block_batches, batch_idx) - 1
+        block_end = self.block_rows[block+1] if block+1 < len(self.block_rows) else self.dataset_size
+        start = self.block_rows[block] + (batch_idx - self.block_batches[block]) * self.batch_size
+        return start, min(start + self.batch_size, block_end)
+
+    def snapshot_rows(self, setting, snap_idx):
+        if setting not in self.snapshots[snap_idx]:
+            raise ValueError('Undefined test setting: {}.'.format(setting))
+        snapshot = self.snapshots[snap_idx][setting]
+        return tuple(snapshot['train']), tuple(snapshot['test'])
+
+    def export_snapshot_files(self, path=None, settings=('remain', 'fixed', 'next')):
+        # Write the train/test text files of every snapshot by resolving the row ranges of the manifest
+        if path is None:
+            path = os.path.join(self.prefix, self.dataset, self.suffix, self.s_fname, 'snapshots')
+        if not os.path.exists(path):
+            os.mkdir(path)
 
-            #snapshot_train = self.data_df[:(self.n_train_batches + snap_boundary) * self.batch_size].values.astype(np.int64)
-            snapshot_test = self.data_df[(self.n_train_batches + self.snap_boundaries[-1]) * self.batch_size:].values.astype(np.int64)
-            utils.write_interactions_to_file(os.path.join(self.snapshots_path, 'fixed_train_snap'+str(idx)), snapshot_train)
-            utils.write_interactions_to_file(os.path.join(self.snapshots_path, 'fixed_test_snap'+str(idx)), snapshot_test)
-            #utils.write_interactions_to_file(os.path.join(self.snapshots_path, 'fixed_train_new_snap'+str(idx)), snapshot_train_new)
+        store = self.interactions
+        for idx in range(len(self.snapshots)):
+            for setting in settings:
+                for part, (start, end) in zip(['train', 'test'], self.snapshot_rows(setting, idx)):
+                    data = np.stack([store.users[start:end], store.items[start:end]], axis=1)
+                    utils.write_interactions_to_file(os.path.join(path, '{}_{}_snap{}'.format(setting, part, idx)), data)
+        logging.info('Exported snapshot files to {}'.format(path))
+
+    def append(self, filename):
+        """
+        Append a new block of interactions (a csv file with user_id and item_id columns, in time order) to the corpus
+        as one new test snapshot: only the new rows are written to the interaction store and inserted into the
+        user-item index, and the snapshot manifest is rewritten.
+        """
+        t0 = time.time()
+        logging.info('Appending interactions from \"{}\"'.format(filename))
+        digest = hashlib.sha1()
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        digest = digest.hexdigest()
+        if digest in self.appended_files:
+            logging.info('Already appended to the corpus, skipped: {}'.format(filename))
+            return
+
+        store = self.interactions
+        start = store.n_rows
+        for users, items in self._read_chunks(filename):
+            if len(users) == 0:
+                continue
+            self.n_users = max(self.n_users, int(users.max()) + 1)
+            self.n_items = max(self.n_items, int(items.max()) + 1)
+            store.append(users, items)
+        n_new_rows = store.n_rows - start
+        if n_new_rows == 0:
+            logging.info('No interactions to append')
+            return
+
+        n_new_pairs = self.user_index.add(store.users[start:], store.items[start:], self.n_users)
+        self.user_index.save(self.user_index.path)
+
+        # The new rows form a block of their own, so the new snapshot starts with a new batch at the first new row
+        # (the last batch of the previous block stays partial); a last snapshot without batches takes the new rows
+        boundary = self.n_batches - self.n_train_batches
+        self.block_rows.append(self.dataset_size)
+        self.block_batches.append(self.n_batches)
+        self.dataset_size += n_new_rows
+        self.n_batches += math.ceil(n_new_rows/self.batch_size)
+        self.n_test_batches = self.n_batches - self.n_train_batches
+        if boundary > self.snap_boundaries[-1]:
+            self.snap_boundaries.append(boundary)
+            self.n_snapshots = len(self.snap_boundaries)
+        self._save_snapshot_manifest()
+        # Recorded last, so that a failed append is not skipped when it is retried
+        self.appended_files.append(digest)
+
+        logging.info('"# user": {}, "# item": {}, "# entry": {} (+{}, {} new user-item pairs)'.format(
+            self.n_users, self.n_items, self.dataset_size, n_new_rows, n_new_pairs))
+        logging.info('Snap boundaries: {}'.format(self.snap_boundaries))
+        logging.info('Done! [{:<.2f} s]'.format(time.time() - t0) + os.linesep)
 
-            #snapshot_train = self.data_df[:(self.n_train_batches + snap_boundary) * self.batch_size].values.astype(np.int64)
-            if idx == len(self.snap_boundaries)-1:
-                snapshot_test = self.data_df[(self.n_train_batches + snap_boundary) * self.batch_size:].values.astype(np.int64)
-            else:
-                gap = self.snap_boundaries[idx+1] - self.snap_boundaries[idx]
-                snapshot_test = self.data_df[(self.n_train_batches + snap_boundary) * self.batch_size:(self.n_train_batches + snap_boundary + gap) * self.batch_size].values.astype(np.int64)
-            utils.write_interactions_to_file(os.path.join(self.snapshots_path, 'next_train_snap'+str(idx)), snapshot_train)
-            utils.write_interactions_to_file(os.path.join(self.snapshots_path, 'next_test_snap'+str(idx)), snapshot_test)
-            #utils.write_interactions_to_file(os.path.join(self.snapshots_path, 'next_train_new_snap'+str(idx)), snapshot_train_new)
+    def _read_chunks(self, filename):
+        # Only the user/item columns are parsed, as int32, and a chunk is validated before it is yielded
+        reader = pd.read_csv(filename, sep=self.sep, usecols=['user_id', 'item_id'],
+                             dtype={'user_id': np.int32, 'item_id': np.int32}, chunksize=self.read_chunksize)
+        for chunk in reader:
+            users, items = chunk['user_id'].to_numpy(), chunk['item_id'].to_numpy()
+            if len(chunk) > 0 and (users.min() < 0 or items.min() < 0):
+                row = chunk.index[(users < 0) | (items < 0)][0]
+                raise ValueError('Negative user/item id in row {} of {}'.format(row, filename))
+            yield users, items
 
     def _read_data(self):
+        # Let the main runner decide the ratio of train/test
         logging.info('Reading data from \"{}\", dataset = \"{}\", suffix = \"{}\", fname = \"{}\" '.format(self.prefix, self.dataset, self.suffix, self.fname))
-        self.df = pd.read_csv(os.path.join(self.prefix, self.dataset, self.suffix, self.fname +'.csv'), sep=self.sep)  # Let the main runner decide the ratio of train/test
-        self.data_df = self.df.loc[:, ['user_id', 'item_id']]#.values.astype(np.int64) # (number of items, 2)
-
-    def _save_user_clicked_set(self):
-        user_clicked_set_path = os.path.join(self.prefix, self.dataset, self.suffix, self.s_fname, 'user_clicked_set.txt')
-        logging.info('Load user_clicked_set')
-
-        try:
-            self.user_clicked_set = pickle.load(open(user_clicked_set_path, 'rb'))
-            logging.info("Successfully loaded saved user_clicked_set")
-        except FileNotFoundError as e:
-            logging.info('File not found, create user_clicked_set')
-            self.user_clicked_set = self.data_df.groupby(['user_id'])['item_id'].unique().to_dict()
-            pickle.dump(self.user_clicked_set, open(user_clicked_set_path, 'wb'))
-            logging.info('Saved user_clicked_set')
-
-    def _save_mini_batch(self):
-        self.mini_batch_path = os.path.join(self.prefix, self.dataset, self.suffix, self.s_fname, 'mini_batch')
-        if not os.path.exists(self.mini_batch_path):
-            os.mkdir(self.mini_batch_path)
-
-        for batch_idx in range(self.n_batches):
-            ui_batch = torch.from_numpy(self.data_df[batch_idx*self.batch_size:(batch_idx+1)*self.batch_size].values.astype(np.int64)) # (batch_size, 2)
-            torch.save(ui_batch, open(os.path.join(self.mini_batch_path, str(batch_idx)+'.pt'), 'wb'))
-
-    def _randint_w_exclude(self, clicked_set):
-        randItem = randint(1, self.n_items-1)
-        return self._randint_w_exclude(clicked_set) if randItem in clicked_set else randItem
\ No newline at end of file
+        filename = os.path.join(self.prefix, self.dataset, self.suffix, self.fname +'.csv')
+        self.n_users, self.n_items = 0, 0
+
+        def chunks():
+            for users, items in self._read_chunks(filename):
+                if len(users) > 0:
+                    self.n_users = max(self.n_users, int(users.max()) + 1)
+                    self.n_items = max(self.n_items, int(items.max()) + 1)
+                yield users, items
+
+        self._save_interactions(chunks())
+        self.dataset_size = InteractionStore(self.interactions_path).n_rows
+
+    def _save_user_index(self):
+        # Built from the interaction store that was just (re)written: a saved index may describe an older store
+        # (e.g., with appended interactions), and UserItemIndex.load opens files lazily without any check
+        user_index_path = os.path.join(self.prefix, self.dataset, self.suffix, self.s_fname, 'user_index')
+        logging.info('Create user_index')
+        store = InteractionStore(self.interactions_path)
+        self.user_index = UserItemIndex.build(store.users, store.items, self.n_users)
+        self.user_index.save(user_index_path)
+        logging.info('Saved user_index')
+
+    def _save_interactions(self, chunks):
+        # One sequential write of the user/item columns; mini-batches are sliced from it by batch index
+        self.interactions_path = os.path.join(self.prefix, self.dataset, self.suffix, self.s_fname, 'interactions.bin')
+        InteractionStore.write_chunks(self.interactions_path, chunks)
@@ -4,20 +4,141 @@ import os
 import gc
 import copy
 import torch
+import pickle
+import queue
 import logging
+import threading
 import numpy as np
-import random
 from time import time
 from tqdm import tqdm
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Subset
 from typing import Dict, List, NoReturn
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing as mp
 
-from utils import utils
+from utils import utils, metrics
 from models.Model import Model
+from helpers import TopKIndex
 
 import matplotlib.pyplot as plt
 
 
+class LossMeter(object):
+    """
+    Running sums of the training losses kept on the device, so that a training step does not wait for the host.
+    Values are copied to the host only by mean() and the non-finite check only by nonfinite().
+    """
+    OPTIONAL = ('fair_loss', 'pd')  # nan when undefined for a batch (e.g., a batch of users of a single group)
+
+    def __init__(self):
+        self.sums = dict()
+        self.counts = dict()
+        self.invalid = None
+
+    def add(self, **values):
+        # None or nan values of the optional losses are not counted; a non-finite value of another loss marks
+        # the run as non-finite. Sums are kept in fp32 (reduced-precision losses would stop accumulating over an epoch)
+        for name, value in values.items():
+            if value is None:
+                continue
+            value = value.float()
+            if name in self.OPTIONAL:
+                valid = ~torch.isnan(value)
+                value = torch.where(valid, value, torch.zeros_like(value))
+            else:
+                valid = torch.ones_like(value, dtype=torch.bool)
+                self._mark(~torch.isfinite(value))
+            if name in self.sums:
+                self.sums[name] = self.sums[name] + value
+                self.counts[name] = self.counts[name] + valid
+            else:
+                self.sums[name] = value.clone()
+                self.counts[name] = valid.long()
+
+    def _mark(self, invalid):
+        self.invalid = invalid if self.invalid is None else self.invalid | invalid
+
+    def check(self, prediction):
+        self._mark(~torch.isfinite(prediction).all())
+
+    def nonfinite(self):
+        return self.invalid is not None and bool(self.invalid)
+
+    def mean(self, name):
+        # nan if nothing was added
+        if name not in self.sums:
+            return float('nan')
+        return (self.sums[name] / self.counts[name]).item()
+
+
+class BatchPrefetcher(object):
+    """
+    Loads the mini-batches of a sequence of snapshots (one DataLoader each) in a background thread into a bounded
+    queue, so that at most `size` batches wait in memory and loading overlaps with training on the previous snapshot.
+    Iterating yields (snap_idx, list of the batches of the snapshot).
+    """
+    _END = object()  # end of a snapshot
+
+    def __init__(self, loaders, size):
+        self.loaders = loaders
+        self.queue = queue.Queue(maxsize=size)
+        self.wait_time = 0.
+        self.thread = threading.Thread(target=self._load, daemon=True)
+
+    def _load(self):
+        try:
+            for dl in self.loaders:
+                for current in dl:
+                    self.queue.put(current)
+                self.queue.put(self._END)
+        except Exception as e:
+            # Raised again in the consuming thread
+            self.queue.put(e)
+
+    def _get(self):
+        t = time()
+        item = self.queue.get()
+        self.wait_time += time() - t
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    def __iter__(self):
+        self.thread.start()
+        for snap_idx in range(len(self.loaders)):
+            batches = list()
+            current = self._get()
+            while current is not self._END:
+                batches.append(current)
+                current = self._get()
+            yield snap_idx, batches
+
+
+class MultiOptimizer(object):
+    """
+    Several optimizers (e.g., for the sparse and the dense parameters) stepped together as one.
+    The state dict is the list of their state dicts.
+    """
+    def __init__(self, optimizers):
+        self.optimizers = optimizers
+
+    def zero_grad(self):
+        for optimizer in self.optimizers:
+            optimizer.zero_grad()
+
+    def step(self):
+        for optimizer in self.optimizers:
+            optimizer.step()
+
+    def state_dict(self):
+        return [optimizer.state_dict() for optimizer in self.optimizers]
+
+    def load_state_dict(self, state_dict):
+        for optimizer, state in zip(self.optimizers, state_dict):
+            optimizer.load_state_dict(state)
+
+
 class Runner(object):
     @staticmethod
     def parse_runner_args(parser):
@@ -37,6 +158,14 @@ class Runner(object):
                             help='Number of processors when prepare batches in DataLoader')
         parser.add_argument('--pin_memory', type=int, default=1,
                             help='pin_memory in DataLoader')
+        parser.add_argument('--prefetch', type=int, default=0,
+                            help='Stream the fine-tuning snapshots through a background queue of this many batches (0: preload all).')
+        parser.add_argument('--check_interval', type=int, default=50,
+                            help='Check the predictions for non-finite values every this number of steps (0: at epoch end only).')
+        parser.add_argument('--train_workers', type=int, default=0,
+                            help='Number of processes retraining snapshots in parallel in fulltrain (0: serial).')
+        parser.add_argument('--train_threads', type=int, default=1,
+                            help='Number of CPU threads of each retraining process.')
 
         return parser
 
@@ -53,10 +182,12 @@ class Runner(object):
         self.time = None  # will store [start_time, last_step_time]
 
         self.snap_boundaries = corpus.snap_boundaries
-        self.snapshots_path = corpus.snapshots_path
         self.test_result_file = args.test_result_file
         self.tepoch = args.tepoch
         self.DRM = args.DRM
+        self.check_interval = args.check_interval
+        self.prefetch = args.prefetch
+        self.precision = args.precision
 
 
     def _check_time(self, start=False):
@@ -71,7 +202,15 @@ class Runner(object):
         optimizer_name = self.optimizer_name.lower()
         if optimizer_name == 'adam':
             #logging.info("Optimizer: Adam")
-            if 'parameters' in self.DRM:
+            if model.sparse_emb:
+                # SparseAdam updates only the embedding rows of the batch (their L2 term is added to the loss
+                # in train_recommender_vanilla); the dense layers keep Adam with weight decay
+                optimizers = [torch.optim.SparseAdam(model.sparse_parameters(), lr=self.learning_rate)]
+                dense_groups = [group for group in model.customize_parameters() if len(group['params']) > 0]
+                if len(dense_groups) > 0:
+                    optimizers.append(torch.optim.Adam(dense_groups, lr=self.learning_rate, weight_decay=self.l2))
+                optimizer = MultiOptimizer(optimizers)
+            elif 'parameters' in self.DRM:
                 optimizer = torch.optim.Adam(model.parameters(), lr=self.learning_rate, weight_decay=self.l2)
             else:
                 optimizer = torch.optim.Adam(
@@ -133,25 +272,17 @@ class Runner(object):
         # pre-training
         elif 'pretrain' in self.dyn_method:
             for snap_idx in range(len(self.snap_boundaries)):
-                model.save_model(add_path='_snap{}'.format(snap_idx))             
+                model.save_snapshot(snap_idx)
         # fine-tuning
         elif 'finetune' in self.dyn_method:
             model_ = copy.deepcopy(model) ###
             #model.save_model(add_path='_train') 
 
             self.time_d['pre-train'] = self.time[1] - self.time[0]
-            model.save_model(add_path='_snap{}'.format(0))
+            model.save_snapshot(0)
             
             flag = self.dynamic_prediction(model_, data_dict['test'])
-            with open(args.test_result_file+'_time_test.txt', 'w+') as f:
-                for k, v in self.time_d.items():
-                    f.writelines('{}\t'.format(k))
-                f.writelines('\n')
-                for k, v in self.time_d.items():
-                    f.writelines('{:.4f}\t'.format(v))
-                f.writelines('\n')
-                for k, v in self.time_d.items(): 
-                    f.writelines('{:.4f}\t'.format(v/60))
+            utils.write_time_report(args.test_result_file+'_time_test.txt', self.time_d)
 
         logging.info(os.linesep + "[{:<.1f} m] ".format((self.time[1] - self.time[0]) / 60))
 
@@ -162,30 +293,20 @@ class Runner(object):
         gc.collect()
         torch.cuda.empty_cache()
 
-        loss_lst, ori_loss_lst, fair_loss_lst = list(), list(), list()
-        pd_list = list()
+        meter = LossMeter()
         dl = DataLoader(data, batch_size=1, shuffle=True, num_workers=self.num_workers, pin_memory=self.pin_memory)
         
         #for current in tqdm(dl, leave=True, desc='Epoch {:<3}'.format(epoch), ncols=100, mininterval=1):
         flag = 0
-        for current in dl:
+        for step, current in enumerate(dl):
             current = utils.batch_to_gpu(utils.squeeze_dict(current), model._device)
             current['batch_size'] = len(current['user_id'])
-            loss, prediction, ori_loss, fair_loss, pd = self.train_recommender_vanilla(model, current, data)
-
-            loss_lst.append(loss)
-            ori_loss_lst.append(ori_loss)
-            if fair_loss is not None:
-                fair_loss_lst.append(fair_loss)
-            if pd is not None:
-                pd_list.append(pd)
-
-
-            flag = np.isnan(prediction).any()
+            flag = self.train_step(model, current, data, meter, step)
             if flag: 
                 break
+        flag = flag or meter.nonfinite()
 
-        return np.mean(loss_lst).item(), np.mean(ori_loss_lst).item(), np.mean(fair_loss_lst).item(), np.mean(pd_list).item(), flag
+        return meter.mean('loss'), meter.mean('ori_loss'), meter.mean('fair_loss'), meter.mean('pd'), flag
 
     def dynamic_prediction(self,
                 model: torch.nn.Module,
@@ -207,94 +328,104 @@ class Runner(object):
                 starts.append(self.snap_boundaries[i-1])
             ends.append(self.snap_boundaries[i])
 
-        snap_idx = 0
-        data_custom = {}
-        for start, end in zip(starts, ends):
-            data_custom[snap_idx] = []
-            data.fine_tune_snap_idx = snap_idx
-
-            dl = DataLoader(data, batch_size=1, shuffle=False, num_workers=0, pin_memory=self.pin_memory)
-            for i, current in enumerate(dl):
-                if i < start:
-                    continue
-                if i >= end:
-                    break
+        # Only the mini-batches of each snapshot are loaded (each test batch exactly once over all snapshots)
+        loaders = [DataLoader(Subset(data, range(max(start, 0), end)), batch_size=1, shuffle=False, num_workers=0,
+                              pin_memory=self.pin_memory) for start, end in zip(starts, ends)]
 
-                current = utils.batch_to_gpu(utils.squeeze_dict(current), model._device)
-                current['batch_size'] = len(current['user_id'])
-                data_custom[snap_idx].append(current)
-            #print(data_custom[snap_idx])
-            snap_idx += 1
+        if self.prefetch > 0:
+            # Streaming: snapshot t+1 is loaded in the background while fine-tuning on snapshot t
+            snapshots = BatchPrefetcher(loaders, self.prefetch)
+            self.time_d['test batch collecting'] = 0.
+        else:
+            snapshots = list()
+            for snap_idx, dl in enumerate(loaders):
+                snapshots.append((snap_idx, [self._batch_to_device(current, model) for current in dl]))
 
-        t = self._check_time()
-        logging.info('test batch collecting: {} s'.format(t))
-        self.time_d['test batch collecting'] = t
+            t = self._check_time()
+            logging.info('test batch collecting: {} s'.format(t))
+            self.time_d['test batch collecting'] = t
 
         flag = 0
-        for snap_idx, snapshot_data in data_custom.items():
+        for snap_idx, snapshot_data in snapshots:
             logging.info('snap_idx: {}'.format(snap_idx))
 
             
             # snap_idx == 0 -> pretrain data -> skip
             if snap_idx == 0:
                 continue
+            if self.prefetch > 0:
+                snapshot_data = [self._batch_to_device(current, model) for current in snapshot_data]
 
             over_fair_loss_lst = list()
             over_pd_list = list()
             for e in tqdm(range(self.tepoch), desc='Until {:<3}'.format(ends[snap_idx])):
                 gc.collect()
                 torch.cuda.empty_cache()
-                loss_lst = list()
-                ori_loss_lst = list()
-                fair_loss_lst = list()
-                pd_list = list()
+                meter = LossMeter()
                 for i, current in enumerate(snapshot_data):
-                    loss, prediction, ori_loss, fair_loss, pd = self.train_recommender_vanilla(model, current, data)       
-                    loss_lst.append(loss)
-                    ori_loss_lst.append(ori_loss)
-                    if fair_loss is not None:
-                        fair_loss_lst.append(fair_loss)
-                    if pd is not None:
-                        pd_list.append(pd)
-
-                    flag = np.isnan(prediction).any()
+                    flag = self.train_step(model, current, data, meter, i)
                     if flag: 
                         break
+                flag = flag or meter.nonfinite()
 
+                fair_loss = meter.mean('fair_loss')
                 logging.info("Epoch {:<3} loss={:<.4f} ori_loss={:<.4f} fair_loss={:<.4f} ".format(
-                            e + 1, np.mean(loss_lst).item(), np.mean(ori_loss_lst).item(), np.mean(fair_loss_lst).item()))
-                over_fair_loss_lst.append(np.mean(fair_loss_lst).item())
-                over_pd_list.append(np.mean(pd_list).item())
+                            e + 1, meter.mean('loss'), meter.mean('ori_loss'), fair_loss))
+                over_fair_loss_lst.append(fair_loss)
+                over_pd_list.append(meter.mean('pd'))
                 
                 if flag:
                     logging.info('@@@ prediction contains invalid values @@@')
                     flag = 0
                     break
 
-            model.save_model(add_path='_snap{}'.format(snap_idx))
+            model.save_snapshot(snap_idx)
             self.time_d['period_{}'.format(snap_idx)] = self._check_time()
+
+        if self.prefetch > 0:
+            # Time spent waiting for the prefetched batches (included in the periods)
+            logging.info('test batch waiting: {} s'.format(snapshots.wait_time))
+            self.time_d['test batch collecting'] = snapshots.wait_time
        
         return flag
 
+    def _batch_to_device(self, current, model):
+        current = utils.batch_to_gpu(utils.squeeze_dict(current), model._device, non_blocking=bool(self.pin_memory))
+        current['batch_size'] = len(current['user_id'])
+        return current
+
 
     def train_recommender_vanilla(self, model, current, data):
         # Train recommender
         model.train()
         # Get recommender's prediction and loss from the ``current'' data at t
-        prediction = model(current['user_id'], current['item_id'], self.DRM)
-        loss, ori_loss, fair_loss, pd = model.loss(prediction, current, data, reduction='mean')
+        with utils.autocast(self.precision, model._device):
+            prediction = model(current['user_id'], current['item_id'], self.DRM)
+            loss, ori_loss, fair_loss, pd = model.loss(prediction, current, data, reduction='mean')
 
         # Update the recommender
         model.optimizer.zero_grad()
-        loss.backward()
+        if model.sparse_emb:
+            (loss + self.l2 * model.touched_rows_l2(current['user_id'], current['item_id'])).backward()
+        else:
+            loss.backward()
         model.optimizer.step()
 
+        # Detached device tensors: nothing is copied to the host here
         if fair_loss is not None:
-            fair_loss = fair_loss.cpu().data.numpy()
+            fair_loss = fair_loss.detach()
         if pd is not None:
-            pd = pd.cpu().data.numpy()
+            pd = pd.detach()
 
-        return loss.cpu().data.numpy(), prediction.cpu().data.numpy(), ori_loss.cpu().data.numpy(), fair_loss, pd
+        return loss.detach(), prediction.detach(), ori_loss.detach(), fair_loss, pd
+
+    def train_step(self, model, current, data, meter, step):
+        # One update; the losses are accumulated in the meter and the predictions are checked for non-finite
+        # values every check_interval steps (the only host synchronization of the step)
+        loss, prediction, ori_loss, fair_loss, pd = self.train_recommender_vanilla(model, current, data)
+        meter.add(loss=loss, ori_loss=ori_loss, fair_loss=fair_loss, pd=pd)
+        meter.check(prediction)
+        return self.check_interval > 0 and (step + 1) % self.check_interval == 0 and meter.nonfinite()
 
 
 
@@ -309,6 +440,18 @@ class Tester(object):
                             help='["ndcg1","f1","recall"]')
         parser.add_argument('--test_result_file', type=str, default='',
                             help='')
+        parser.add_argument('--test_batch_users', type=int, default=2048,
+                            help='The number of users scored together in a block during evaluation.')
+        parser.add_argument('--test_workers', type=int, default=0,
+                            help='Number of processes evaluating snapshot checkpoints in parallel (0: serial).')
+        parser.add_argument('--test_threads', type=int, default=1,
+                            help='Number of CPU threads of each evaluation process.')
+        parser.add_argument('--precision_tol', type=float, default=0,
+                            help='With a reduced precision, max. difference of the last snapshot metrics from fp32, beyond which all snapshots are evaluated in fp32 (0: no check).')
+        parser.add_argument('--retrieval_report', type=str, default='',
+                            help='Report the recall and latency of a top-K retrieval backend (exact, ivf) for each BPR snapshot.')
+        parser.add_argument('--retrieval_probe', type=int, default=8,
+                            help='Number of probed clusters of the ivf retrieval backend.')
 
         return parser
 
@@ -323,25 +466,24 @@ class Tester(object):
         #test_settings = ['remain','next','fixed']
         test_settings = ['remain', 'next']
 
-        for topk in self.topk:
-            for setting in test_settings:
-                for snap_idx in range(len(self.snap_boundaries)):
-                    # if os.path.exists(os.path.join(self.test_result_file, '{}_snap{}.txt'.format(setting, len(self.snap_boundaries)-1))):
-                    #     print('Already existing test files: {}'.format(os.path.join(self.test_result_file, '{}_snap{}.txt'.format(setting, len(self.snap_boundaries)-1))))
-                    #     break
+        # Each checkpoint is loaded once; each setting is evaluated once for all top-K values
+        snap_indices = range(len(self.snap_boundaries))
+        last_results = self.write_snapshot_results(model, snap_indices, test_settings)
 
-                    model.load_model(add_path='_snap{}'.format(snap_idx), flag=1)
-                    model.eval()
+        if self.precision != 'fp32' and self.precision_tol > 0:
+            max_diff = self.check_precision(model, snap_indices[-1], test_settings, last_results)
+            if max_diff > self.precision_tol:
+                # The reduced-precision results are not kept: all snapshots are evaluated again in fp32
+                logging.warning('{} metrics of snapshot {} differ from fp32 by {:.4f} (> {}), evaluating in fp32'.format(
+                    self.precision, snap_indices[-1], max_diff, self.precision_tol))
+                self.precision = 'fp32'
+                self.write_snapshot_results(model, snap_indices, test_settings)
 
-                    train_file = os.path.join(self.snapshots_path, '{}_train_snap{}'.format(setting, snap_idx))
-                    test_file = os.path.join(self.snapshots_path, '{}_test_snap{}'.format(setting, snap_idx))
-                    result_str, info_str = self.recommendation(model, train_file, test_file, topk)
-
-                    result_filename_ = os.path.join(self.test_result_file, '{}_{}_snap{}.txt'.format(topk, setting, snap_idx))
-                    r_string = 'Top {} Results'.format(topk) + result_str #'\n\n\n\n' + info_str 
-                    with open(result_filename_, 'w+') as f:
-                        f.writelines(r_string)
+        if self.retrieval_report:
+            self.write_retrieval_report(model, snap_indices)
 
+        for topk in self.topk:
+            for setting in test_settings:
                 # mean values over snapshots
                 d = {}
                 for snap_idx in range(len(self.snap_boundaries)):
@@ -391,14 +533,95 @@ class Tester(object):
 
 
 
+    def write_snapshot_results(self, model, snap_indices, test_settings):
+        # Evaluate the snapshot checkpoints and write their result files; returns the results of the last snapshot
+        if self.test_workers > 0:
+            # Independent snapshot evaluations in separate processes; the sampling in recommendation() is seeded
+            # per call, so the results are the same as the serial ones.
+            # The model is sent as plain pickled bytes: torch's own reduction would move its parameters to shared
+            # memory, and the workers would then load their checkpoints into the same tensors
+            # (the pool is shut down, and its workers ended, also when an evaluation raises)
+            model_bytes = pickle.dumps(model)
+            with ProcessPoolExecutor(self.test_workers, mp_context=mp.get_context('spawn'),
+                                     initializer=utils.init_worker, initargs=(self.test_threads, self.random_seed)) as pool:
+                futures = [pool.submit(self.evaluate_snapshot, model_bytes, snap_idx, test_settings) for snap_idx in snap_indices]
+                snapshot_results = [future.result() for future in futures]
+        else:
+            snapshot_results = (self.evaluate_snapshot(model, snap_idx, test_settings) for snap_idx in snap_indices)
+
+        for snap_idx, setting_results in zip(snap_indices, snapshot_results):
+            last_results = setting_results
+            for setting, results in setting_results.items():
+                for topk, (result_str, info_str) in results.items():
+                    result_filename_ = os.path.join(self.test_result_file, '{}_{}_snap{}.txt'.format(topk, setting, snap_idx))
+                    r_string = 'Top {} Results'.format(topk) + result_str #'\n\n\n\n' + info_str 
+                    with open(result_filename_, 'w+') as f:
+                        f.writelines(r_string)
+        return last_results
+
+    def evaluate_snapshot(self, model, snap_idx, test_settings):
+        if isinstance(model, bytes):
+            # A private copy of the model in an evaluation process
+            model = pickle.loads(model)
+        model.load_model(add_path='_snap{}'.format(snap_idx), flag=1)
+        model.eval()
+        return {setting: self.recommendation(model, setting, snap_idx, self.topk) for setting in test_settings}
+
+    def check_precision(self, model, snap_idx, test_settings, results):
+        # Evaluate the snapshot again in fp32 and compare the metrics (overall, per group and unfairness)
+        precision, self.precision = self.precision, 'fp32'
+        fp32_results = self.evaluate_snapshot(model, snap_idx, test_settings)
+        self.precision = precision
+
+        def parse(result_str):
+            return {name: float(value) for name, value in (line.split() for line in result_str.strip().split('\n'))}
+
+        max_diff = 0.
+        for setting in test_settings:
+            for topk in self.topk:
+                values, fp32_values = parse(results[setting][topk][0]), parse(fp32_results[setting][topk][0])
+                max_diff = max([max_diff] + [abs(values[name] - fp32_values[name]) for name in fp32_values])
+        if max_diff <= self.precision_tol:
+            logging.info('{} metrics of snapshot {} are within {} of fp32 (max. difference {:.4f})'.format(
+                self.precision, snap_idx, self.precision_tol, max_diff))
+        return max_diff
+
+    def write_retrieval_report(self, model, snap_indices):
+        # Top-K retrieval over the item table of each checkpoint against the exact top-K (inner-product models only)
+        if not hasattr(model, 'i_embeddings'):
+            logging.info('No retrieval report: {} has no item embedding table'.format(type(model).__name__))
+            return
+        kwargs = {'n_probe': self.retrieval_probe} if self.retrieval_report == 'ivf' else {}
+        report = TopKIndex.recall_report(model.model_path, snap_indices, self.K, self.retrieval_report,
+                                         random_seed=self.random_seed, **kwargs)
+        with open(os.path.join(self.test_result_file, '0_{}_retrieval_{}.txt'.format(self.K, self.retrieval_report)), 'w+') as f:
+            f.writelines('snap\trecall\tquery_ms\texact_ms\tbuild_s\n')
+            for r in report:
+                f.writelines('{}\t{:.4f}\t{:.4f}\t{:.4f}\t{:.2f}\n'.format(
+                    r['snap_idx'], r['recall'], r['query_ms'], r['exact_ms'], r['build_s']))
+
     def __init__(self, args, corpus):
         self.user_attr_file = corpus.user_attr_path
         self.snap_boundaries = corpus.snap_boundaries
-        self.snapshots_path = corpus.snapshots_path
+        self.corpus = corpus  # reader object reference
+        self.n_users = corpus.n_users
+        self.user_index = corpus.user_index
+        self.store = corpus.interactions
+        # Snapshot views are built once from the interaction store and shared by settings, snapshots and top-K values
+        self.views = OrderedDict()
+        self.max_cached_views = 8
         self.num_neg_samples = 100
         if args.dataset == 'Modcloth':
             self.num_neg_samples = 100
         self.test_result_file = args.test_result_file
+        self.test_batch_users = args.test_batch_users
+        self.test_workers = args.test_workers
+        self.test_threads = args.test_threads
+        self.random_seed = args.random_seed
+        self.precision = args.precision
+        self.precision_tol = args.precision_tol
+        self.retrieval_report = args.retrieval_report
+        self.retrieval_probe = args.retrieval_probe
 
         self.topk = eval(args.test_topk)
         self.K = self.topk[0]
@@ -407,189 +630,117 @@ class Tester(object):
 
         print('Test start: topk: {}, metric: {}'.format(self.topk, self.metrics))
 
-        # MovieLens-1M: i=0: gender, i=1: age, i=2: occupation
-        binary = list(range(2)) # ['M'=0,'F'=1]
-
+        # MovieLens-1M: attr_col=1: gender, attr_col=2: age, attr_col=3: occupation
         if args.dataset == 'Modcloth':
             self.attr_type = ['body-shape']
         else:
-            self.attr_type = ['genders']
-        self.user_groups = [binary]
+            self.attr_type = [{1: 'genders', 2: 'ages', 3: 'occupations'}.get(args.attr_col, 'attr{}'.format(args.attr_col))]
 
-        #self.set_user_attr(train_file, user_attr_file, self.num_groups_degree)
         self.num_type_attr = 1
+        self.set_user_attr(self.user_attr_file, corpus.n_users, args.attr_col)
         
 
-    def set_user_attr(self, train_file, user_attr_file):
-        train_edges = utils.read_data_from_file_int(train_file)
-        train_user_set, _ = utils.get_user_item_set(train_edges)
-
-        # MovieLenz
-        user_attr = utils.read_data_from_file_int(user_attr_file)
-        user_attr_dict = {}
-        for user in user_attr:
-            #user_attr_dict[user[0]] = [user[1], user[2], user[3]]
-            user_attr_dict[user[0]] = [user[1]]
-        self.user_attr = {}
-
-        for u_idx in train_user_set:
-            self.user_attr[u_idx] = [user_attr_dict[u_idx][0]]
-
-    def init_results(self):
-
-        self.results = {k: 0.0 for k in self.metrics}
-        self.num_test_users = 0
-
-        self.results_user_attr = []
-        self.num_users_per_group = []
-        self.fairness_results = []
-        for k in range(self.num_type_attr):
-            self.results_user_attr.append({})
-            self.num_users_per_group.append({})
-            for attr in self.user_groups[k]:
-                self.results_user_attr[k][attr] = {}
-                for metric in self.metrics:
-                    self.results_user_attr[k][attr][metric] = 0
-                self.num_users_per_group[k][attr] = 0
-
-        self.num_actual_users_per_group = copy.deepcopy(self.num_users_per_group)
-        self.num_unseen_items_per_group = copy.deepcopy(self.num_users_per_group)
-        self.num_test_pos_per_group = copy.deepcopy(self.num_users_per_group)
-        self.num_train_pos_per_group = copy.deepcopy(self.num_users_per_group)
-        
-
-    def generate_recommendation_list_for_a_user(self, model, user, train_item_set, train_pos, test_pos, K, num_neg_samples=-1):
-
-        #num_neg_samples = 100
-        verbose = False
-        # if user == 0:
-        #   verbose = True
-
-        new_item_set = list(set(train_item_set) - set(train_pos[user]) - set(test_pos[user]))
+    def set_user_attr(self, user_attr_file, n_users, attr_col=1):
+        # Dense group ids (indexed by user id) for each type of attribute; groups are named by their attribute values
+        # (Modcloth and genders: ['M'=0,'F'=1])
+        user_attr, values = utils.read_user_attr(user_attr_file, n_users, attr_col)
+        self.user_attr = [user_attr]
+        self.user_groups = [values]
 
+    def generate_recommendation_lists(self, model, users, train_item_set, test_index, seen_index, K, num_neg_samples, random_state):
+        # Candidates of each user: its test items followed by sampled (or all) train items unseen by the user
+        test_items = [test_index.items_of(user) for user in users]
         if num_neg_samples != -1:
-            if num_neg_samples > len(new_item_set):
-                print(len(new_item_set))
-                print('numer of train_item_set {}'.format(len(train_item_set)))
-                print('number of items of the user {}'.format(len(train_pos[user])))
-                print('number of test pos items of the user {}'.format(len(test_pos[user])))
-            neg_samples = random.sample(new_item_set, num_neg_samples)
+            neg_samples = seen_index.sample_excluded(users, num_neg_samples, pool=train_item_set, random_state=random_state)
         else:
-            neg_samples = new_item_set
+            neg_samples = [train_item_set[~seen_index.contains(user, train_item_set)] for user in users]
 
-        #print('check@@@ {}'.format(train_item_set+neg_samples))
-        relevances = {}
-        cnt = 0
+        n_candidates = np.array([len(t) + len(n) for t, n in zip(test_items, neg_samples)])
+        candidates = np.zeros((len(users), n_candidates.max()), dtype=np.int64)
+        for row, (t, n) in enumerate(zip(test_items, neg_samples)):
+            candidates[row, :len(t)] = t
+            candidates[row, len(t):n_candidates[row]] = n
+        padding = np.arange(candidates.shape[1])[None, :] >= n_candidates[:, None]
 
+        # Score the (users x candidates) block at once and keep the top-K of each row
         # In case of unseen test items, just use random embeddings of the model.
-        # (n_items)
-        candidate_items = test_pos[user] + neg_samples
-
-        user_ = torch.from_numpy(np.array(user))
-        candidate_items_ = torch.from_numpy(np.array(candidate_items))
-        if torch.cuda.is_available():
-            user_ = user_.to(model._device)
-            candidate_items_ = candidate_items_.to(model._device)
-
-        item_relevances = model.get_relevances(model, user_, candidate_items_)
-
-        for item, relevance in zip(candidate_items, item_relevances):
-            if item in train_item_set:
-                relevances[item] = relevance
-                #relevances[item] = train_embeddings[0][user] @ train_embeddings[1][item]
+        k = candidates.shape[1] if K <= 0 else min(K, candidates.shape[1])
+        with torch.no_grad():
+            with utils.autocast(self.precision, model._device):
+                scores = model.score(users, candidates).float()
+            scores[torch.from_numpy(padding).to(model._device)] = -np.inf
+            top = scores.topk(k, dim=1).indices.cpu().numpy()
+        top_items = np.take_along_axis(candidates, top, axis=1)
+
+        # Lists of users with less than K candidates are shorter than K
+        n_rec = np.minimum(n_candidates, k)
+
+        return top_items, n_rec
+
+    def __getstate__(self):
+        # Evaluation processes build their own snapshot views
+        state = self.__dict__.copy()
+        state['views'] = OrderedDict()
+        return state
+
+    def get_view(self, *rows):
+        # Merge adjacent row ranges so that equal sets of rows share one cached view
+        ranges = []
+        for start, end in sorted(rows):
+            if ranges and start <= ranges[-1][1]:
+                ranges[-1] = (ranges[-1][0], max(ranges[-1][1], end))
             else:
-                relevances[item] = relevance
-                cnt += 1
-
-        sorted_relevances = sorted(relevances.items(), key=lambda x: x[1], reverse=True)
-
-        if K > 0:
-            recommendation_list = [rel[0] for rel in sorted_relevances][:K]
-        else:
-            recommendation_list = [rel[0] for rel in sorted_relevances]
-        
-        if verbose:
-            print(recommendation_list)
-            print('@@@CHECK length of rec list: {} = {}, no test item{}'.format(len(recommendation_list), K, cnt))
-
-        return recommendation_list, cnt
-
-    def measure_performance_for_a_user(self, user, recommendation_list, train_pos, test_pos, num_unseen_items):
-        flag = 0
-
-        for metric in self.metrics:
-
-            if test_pos.get(user) is not None:
-
-                if metric == 'recall':
-                    value = self.measure_recall(recommendation_list, test_pos[user])
-                elif metric == 'ndcg1':
-                    value = self.measure_ndcg(recommendation_list, test_pos[user], method=1)
-                elif metric == 'f1':
-                    value = self.measure_f1(recommendation_list, test_pos[user])
-                else:
-                    raise ValueError('Undefined evaluation metric: {}.'.format(metric))
-
-                self.results[metric] += value
-                if flag == 0:
-                    self.num_test_users += 1
-
-                # For each of user groups that are divided by sensitive attributes
-                for k in range(self.num_type_attr):
-                    for attr in self.user_groups[k]:
-                        if self.user_attr[user][k] == attr:
-                            self.results_user_attr[k][attr][metric] += value
-                            # Is the user in the test set or not
-
-                            if flag == 0:
-                                self.num_users_per_group[k][attr] += 1
-                                self.num_unseen_items_per_group[k][attr] += num_unseen_items
-                                self.num_test_pos_per_group[k][attr] += len(test_pos[user])
-                                self.num_train_pos_per_group[k][attr] += len(train_pos[user])
-                
-                flag += 1
-            else:
-                print('@@@@@@@@@error@@@@@@@@@@')
-
-
-    def recommendation(self, model, train_file, test_file, topk=20, num_neg_samples=-1):
-        topk = topk
+                ranges.append((start, end))
+        ranges = tuple(ranges)
+
+        if ranges not in self.views:
+            # All interactions: reuse the index of the corpus
+            index = self.user_index if ranges == ((0, len(self.store)),) else None
+            self.views[ranges] = self.store.view(ranges, self.n_users, index)
+            if len(self.views) > self.max_cached_views:
+                self.views.popitem(last=False)
+        self.views.move_to_end(ranges)
+        return self.views[ranges]
+
+    def recommendation(self, model, setting, snap_idx, topks=[20], num_neg_samples=-1):
         num_neg_samples = self.num_neg_samples
 
-        self.init_results()
-        self.set_user_attr(train_file, self.user_attr_file)
-        #self.num_type_attr = len(self.user_attr[0])
-
         # For each user, there are personalized items in the recommendation list and test positive items
-        # K = max(topk)
-        train_edges = utils.read_data_from_file_int(train_file)
-        test_edges = utils.read_data_from_file_int(test_file)
-        train_pos = utils.get_user_dil_from_edgelist(train_edges)
-        test_pos = utils.get_user_dil_from_edgelist(test_edges)
-        train_user_set, train_item_set = utils.get_user_item_set(train_edges)
-        test_user_set, test_item_set = utils.get_user_item_set(test_edges)
-
+        train_rows, test_rows = self.corpus.snapshot_rows(setting, snap_idx)
+        train = self.get_view(train_rows)
+        test = self.get_view(test_rows)
+        seen = self.get_view(train_rows, test_rows)
+        K = -1 if min(topks) <= 0 else max(topks)
 
         # Do not test new users, which does not exist in the training set
-        # Generate top-k recommendation list for each user
-        # num_neg_samples = -1
-        random.seed(10)
-        for user in train_user_set:
-            # Skip if the user is not in the test set
-            if user in test_pos.keys():
-                recommendation_list, num_unseen_items = self.generate_recommendation_list_for_a_user(model, user, train_item_set, train_pos, test_pos, topk, num_neg_samples)
-                self.measure_performance_for_a_user(user, recommendation_list, train_pos, test_pos, num_unseen_items)
-
-        # print(self.num_unseen_items_per_group)
-
-        self.average_user()
-        self.average_user_attr()
-        self.count_info_per_group(train_user_set, self.num_actual_users_per_group)
-        self.average_info_per_group(self.num_unseen_items_per_group)
-        self.average_info_per_group(self.num_test_pos_per_group)
-        self.average_info_per_group(self.num_train_pos_per_group)
-        #num_actual_train_pos_per_group_total = self.get_average_out_degree_per_groups(self.num_actual_train_pos_per_group, self.num_actual_users_per_group, train_pos)
+        # Skip the users that are not in the test set
+        test_users = np.intersect1d(train.users, test.users).astype(np.int64)
+        # The number of test interactions whose items are unseen in the training data
+        num_unseen_items = np.bincount(test.columns[0], weights=~np.isin(test.columns[1], train.items), minlength=self.n_users)
 
+        # Generate top-K recommendation lists for blocks of users and mark their hits
+        # num_neg_samples = -1
+        random_state = np.random.RandomState(10)
+        hits, n_rec = [], []
+        for start in range(0, len(test_users), self.test_batch_users):
+            users = test_users[start:start+self.test_batch_users]
+            top_items, n_rec_ = self.generate_recommendation_lists(model, users, train.items, test.index, seen.index, K, num_neg_samples, random_state)
+            hits_ = test.index.contains(users[:, None], top_items)
+            hits_ &= np.arange(top_items.shape[1])[None, :] < n_rec_[:, None]
+            hits.append(hits_)
+            n_rec.append(n_rec_)
+        hits, n_rec = np.concatenate(hits), np.concatenate(n_rec)
+
+        # The lists for smaller K are the prefixes of the list for the largest K
+        results = {}
+        for topk in topks:
+            k = hits.shape[1] if topk <= 0 else topk
+            values = metrics.evaluate(self.metrics, hits[:, :k], np.minimum(n_rec, k), test.n_pos[test_users])
+            self.aggregate_results(test_users, values, num_unseen_items[test_users], test.n_pos, train.n_pos, train.users)
+            results[topk] = self.get_results_str_(), self.get_info_str_(train.users)
+        return results
+
+    def get_info_str_(self, train_user_set):
         info_str = ''
         # info_str = '@@@ User Groups @@@'
         # info_str += '\noverall_num_test_users: {}, overall_real_num_test_users: {}'.format(len(train_user_set), self.num_test_users)
@@ -599,13 +750,7 @@ class Tester(object):
         # info_str += '\nThe number of (valid) train positive items per group: {}'.format(self.num_train_pos_per_group)
         # info_str += '\nThe number of actual users per group: {}'.format(self.num_actual_users_per_group)
         # info_str += '\nThe number of actual train positive items per group: {}'.format(self.num_actual_train_pos_per_group)
-
-
-        result_str = self.get_results_str_()
-
-
-        return result_str, info_str
-
+        return info_str
 
     def get_results_str_(self):
         self.measure_unfairness()
@@ -618,157 +763,63 @@ class Tester(object):
                 #result_str += '\n\n@@@ Unfairness values @@@'
                 result_str += '\n{}\t{:.4f}'.format(metric+'__overall', self.results[metric])
 
+                # Binary attributes: difference of the two groups; otherwise the gap between the best and the worst group
                 if self.binary_unfairness[metric].get(k) is not None:
                     result_str += '\n{}\t{:.4f}'.format(metric+'__'+self.attr_type[k], self.binary_unfairness[metric][k])
-                    for attr in self.user_groups[k]:
-                        result_str += '\n{}\t{:.4f}'.format(metric+'__'+str(attr), self.results_user_attr[k][attr][metric])
-
-
                 else:
-                    for attr in self.user_groups[k]:
-                        result_str += '\n{}\t{:.4f}'.format(metric+'__'+str(attr), self.results_user_attr[k][attr][metric])
+                    result_str += '\n{}\t{:.4f}'.format(metric+'__'+self.attr_type[k], self.gap[metric][k])
+                result_str += '\n{}\t{:.4f}'.format(metric+'__'+self.attr_type[k]+'__var', self.variance[metric][k])
+                for attr in self.user_groups[k]:
+                    result_str += '\n{}\t{:.4f}'.format(metric+'__'+str(attr), self.results_user_attr[k][attr][metric])
 
         return result_str
 
     def measure_unfairness(self):
+        # Over the groups with test users
         self.variance = {}
+        self.gap = {}
         self.binary_unfairness = {}
         for metric in self.metrics:
             self.variance[metric] = []
+            self.gap[metric] = []
             self.binary_unfairness[metric] = {}
             for k in range(self.num_type_attr):
                 value_list = []
                 for attr in self.user_groups[k]:
-                    #if self.results_user_attr[k][attr][metric] != 0:
-                    value_list.append(self.results_user_attr[k][attr][metric])
-                self.variance[metric].append(np.var(value_list))
-
-                if len(value_list) == 2:
-                    self.binary_unfairness[metric][k] = value_list[0] - value_list[1]
+                    if self.num_users_per_group[k][attr] > 0:
+                        value_list.append(self.results_user_attr[k][attr][metric])
+                self.variance[metric].append(np.var(value_list) if len(value_list) > 0 else 0.)
+                self.gap[metric].append(max(value_list) - min(value_list) if len(value_list) > 0 else 0.)
+
+                if len(self.user_groups[k]) == 2:
+                    values = [self.results_user_attr[k][attr][metric] for attr in self.user_groups[k]]
+                    self.binary_unfairness[metric][k] = values[0] - values[1]
         #print(self.results_user_attr)
 
-    def count_info_per_group(self, train_user_set, info):
-        for i in train_user_set:
-            for k in range(self.num_type_attr):
-                for attr in self.user_groups[k]:
-                    if self.user_attr[i][k] == attr:
-                        #self.num_actual_users_per_group[k][attr] += 1
-                        info[k][attr] += 1
+    def aggregate_results(self, users, values, num_unseen_items, n_test_pos, n_train_pos, train_user_set):
+        # Overall means and per-group means (segment reductions over the attribute of each user)
+        self.num_test_users = len(users)
+        self.results = {metric: values[metric].mean() for metric in self.metrics}
 
-    def average_info_per_group(self, info):
-        for k in range(self.num_type_attr):
-            for attr in self.user_groups[k]:
-                if self.num_users_per_group[k][attr] == 0:
-                    info[k][attr] = 0
-                else:
-                    info[k][attr] = round(info[k][attr] / self.num_users_per_group[k][attr])
-
-    def average_user_attr(self):
+        self.results_user_attr = []
+        self.num_users_per_group = []
+        self.num_actual_users_per_group = []
+        self.num_unseen_items_per_group = []
+        self.num_test_pos_per_group = []
+        self.num_train_pos_per_group = []
         for k in range(self.num_type_attr):
-            for attr in self.user_groups[k]:
-                for metric in self.metrics:
-                    if self.num_users_per_group[k][attr] == 0:
-                        self.results_user_attr[k][attr][metric] = 0
-                    else:
-                        a = self.results_user_attr[k][attr][metric]
-                        self.results_user_attr[k][attr][metric] /= self.num_users_per_group[k][attr]
-
-    def average_user(self):
-        for metric, value in self.results.items():
-            self.results[metric] = value/self.num_test_users
-
-    def measure_recall(self, rec_list, test_pos):
-        hit_count = np.isin(rec_list, test_pos).sum()
-
-        return hit_count / len(test_pos)
-     
-    def measure_num_hit(self, rec_list, test_pos):
-        return np.isin(rec_list, test_pos).sum()
-
-    # def measure_ndcg_deprecated(self, rec_list, test_pos):
-    #     index = np.arange(len(rec_list))
-    #     k = min(len(rec_list), len(test_pos))
-    #     idcg = (1/np.log2(2+np.arange(k))).sum()
-    #     dcg = (1/np.log2(2+index[np.isin(rec_list, test_pos)])).sum()
-
-    #     return dcg/idcg
-
-    def measure_ndcg(self, rec_list, test_pos, method=1):
-        r = np.asfarray(np.isin(rec_list, test_pos))
-        max_r = np.asfarray(sorted(np.isin(rec_list, test_pos), reverse=True))
-
-        # if r.size:
-        # dcg
-        if method == 0:
-            dcg = r[0] + np.sum(r[1:] / np.log2(np.arange(2, r.size + 1)))
-        elif method == 1:
-            dcg = np.sum(r / np.log2(np.arange(2, r.size + 2)))
-        elif method == 2:
-            return np.sum(r / np.log2(np.arange(2, r.size + 2)))
-
-        # idcg
-        if method == 0:
-            idcg = max_r[0] + np.sum(max_r[1:] / np.log2(np.arange(2, max_r.size + 1)))
-        elif method == 1:
-            idcg = np.sum(max_r / np.log2(np.arange(2, max_r.size + 2)))
-        if not idcg:
-            return 0.
-        else:
-            return dcg / idcg
-
-    def measure_hit_ratio(self, rec_list, test_pos):
-        hit_count = np.isin(rec_list, test_pos).sum()
-
-        if hit_count > 0:
-            return 1.0
-        else:
-            return 0.0
-
-    def measure_precision(self, rec_list, test_pos):
-        hit_count = np.isin(rec_list, test_pos).sum()
-
-        return hit_count / len(rec_list)
-
-    def measure_average_precision(self, rec_list, test_pos, method=0):
-        r = np.isin(rec_list, test_pos)
-        out = [self.measure_precision(rec_list[:k+1], test_pos) for k in range(len(rec_list)) if r[k]]
-
-        if not out:
-            return 0.
-
-        if method==0:
-            return np.mean(out)
-        elif method==1:
-            return sum(out)/min(len(rec_list), len(test_pos))
-        elif method==2:
-            return sum(out)/len(test_pos)
-
-
-    def measure_f1(self, rec_list, test_pos):
-        recall = self.measure_recall(rec_list, test_pos)
-        precision = self.measure_precision(rec_list, test_pos)
-        if recall+precision == 0:
-            value = 0
-        else:
-            value = 2*(recall*precision) / (recall+precision)
-
-        return value
-
-    def measure_mrr(self, rec_list, test_pos, method=0):
-
-        r = np.asfarray(np.isin(rec_list, test_pos))
-
-        if method == 0:
-            rr = np.sum(r / np.arange(1, r.size + 1))   
-        elif method == 1:
-            r_ = 0
-            for rank, i in enumerate(r):
-                if i == 1:
-                    r_ = rank + 1
-                    break
-            if r_ == 0:
-                rr = 0
-            else:
-                rr = 1/r_
+            groups = self.user_attr[k][users]
+            n_groups = len(self.user_groups[k])
+            group_means = {metric: metrics.group_mean(values[metric], groups, n_groups) for metric in self.metrics}
+            self.results_user_attr.append({attr: {metric: group_means[metric][g] for metric in self.metrics}
+                                           for g, attr in enumerate(self.user_groups[k])})
+
+            def per_group(counts):
+                return dict(zip(self.user_groups[k], counts))
+            self.num_users_per_group.append(per_group(metrics.group_sum(np.ones(len(users)), groups, n_groups).astype(int)))
+            self.num_actual_users_per_group.append(per_group(metrics.group_sum(
+                np.ones(len(train_user_set)), self.user_attr[k][train_user_set], n_groups).astype(int)))
+            self.num_unseen_items_per_group.append(per_group(metrics.group_mean(num_unseen_items, groups, n_groups).round().astype(int)))
+            self.num_test_pos_per_group.append(per_group(metrics.group_mean(n_test_pos[users], groups, n_groups).round().astype(int)))
+            self.num_train_pos_per_group.append(per_group(metrics.group_mean(n_train_pos[users], groups, n_groups).round().astype(int)))
 
-        return rr
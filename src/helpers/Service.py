@@ -0,0 +1,212 @@
+# -*- coding: UTF-8 -*-
+
+import json
+import time
+import queue
+import logging
+import threading
+import numpy as np
+import torch
+from collections import OrderedDict
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from helpers.TopKIndex import seen_pairs
+
+
+class Recommender(object):
+    """
+    Top-K recommendations of a loaded _snap{i} checkpoint, scored against the whole catalog (Model.score_all).
+    Results are kept per (user, k, exclude_seen) in an LRU cache, which is cleared when another snapshot is swapped in.
+    """
+    def __init__(self, model, corpus, snap_idx, item_block=65536, cache_size=100000):
+        self.model = model
+        self.user_index = corpus.user_index
+        self.item_block = item_block
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.lock = threading.Lock()
+        self.swap(snap_idx)
+
+    def swap(self, snap_idx):
+        with self.lock:
+            self.model.load_model(add_path='_snap{}'.format(snap_idx), flag=1)
+            self.model.eval()
+            self.snap_idx = snap_idx
+            self.cache.clear()
+        logging.info('Serving snapshot {}'.format(snap_idx))
+
+    def recommend(self, user_ids, k, exclude_seen=True):
+        # Lists of the cached users are reused; the other users are scored together.
+        # Returns the served snapshot with the lists, since a swap may happen right after
+        user_ids = np.asarray(user_ids, dtype=np.int64)
+        with self.lock:
+            lists = [self.cache.get((user, k, exclude_seen)) for user in user_ids.tolist()]
+            missing = np.array([row for row, items in enumerate(lists) if items is None], dtype=np.int64)
+            if len(missing) > 0:
+                top_items = self._top_items(user_ids[missing], k, exclude_seen)
+                for row, items in zip(missing, top_items):
+                    lists[row] = items
+                    self.cache[(int(user_ids[row]), k, exclude_seen)] = items
+            for user in user_ids.tolist():
+                self.cache.move_to_end((user, k, exclude_seen))
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+            return self.snap_idx, lists
+
+    def _top_items(self, users, k, exclude_seen):
+        with torch.no_grad():
+            scores = self.model.score_all(users, self.item_block)
+            if exclude_seen:
+                rows, cols = seen_pairs(self.user_index, users)
+                scores[torch.from_numpy(rows).to(scores.device), torch.from_numpy(cols).to(scores.device)] = -np.inf
+            top = scores.topk(min(k, scores.shape[1]), dim=1)
+        items, valid = top.indices.cpu().numpy(), torch.isfinite(top.values).cpu().numpy()
+        return [row_items[row_valid].tolist() for row_items, row_valid in zip(items, valid)]
+
+
+class MicroBatcher(object):
+    """
+    Collects concurrent recommend requests for up to max_delay seconds (or max_batch users) in a background thread
+    and answers them with one call of the recommender per (k, exclude_seen).
+    """
+    def __init__(self, recommender, max_batch=256, max_delay=0.002):
+        self.recommender = recommender
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self._serve, daemon=True)
+        self.thread.start()
+
+    def submit(self, user_ids, k, exclude_seen=True):
+        future = Future()
+        self.requests.put((list(user_ids), k, exclude_seen, future))
+        return future
+
+    def _collect(self):
+        batch = [self.requests.get()]
+        n_users = len(batch[0][0])
+        deadline = time.time() + self.max_delay
+        while n_users < self.max_batch:
+            try:
+                batch.append(self.requests.get(timeout=max(deadline - time.time(), 0)))
+            except queue.Empty:
+                break
+            n_users += len(batch[-1][0])
+        return batch
+
+    def _serve(self):
+        while True:
+            batch = self._collect()
+            groups = OrderedDict()
+            for request in batch:
+                groups.setdefault((request[1], request[2]), []).append(request)
+            for (k, exclude_seen), requests in groups.items():
+                try:
+                    snap_idx, lists = self.recommender.recommend(sum([r[0] for r in requests], []), k, exclude_seen)
+                except Exception:
+                    # The requests are answered one by one, so that only the failing ones fail
+                    for user_ids, _, _, future in requests:
+                        try:
+                            future.set_result(self.recommender.recommend(user_ids, k, exclude_seen))
+                        except Exception as e:
+                            future.set_exception(e)
+                    continue
+                start = 0
+                for user_ids, _, _, future in requests:
+                    future.set_result((snap_idx, lists[start:start+len(user_ids)]))
+                    start += len(user_ids)
+
+
+class LatencyMeter(object):
+    """
+    Latencies of the answered requests (the last `size`), summarized as percentiles in milliseconds.
+    """
+    def __init__(self, size=100000):
+        self.latencies = []
+        self.size = size
+        self.lock = threading.Lock()
+
+    def add(self, seconds):
+        with self.lock:
+            self.latencies.append(seconds)
+            if len(self.latencies) > self.size:
+                del self.latencies[:len(self.latencies) - self.size]
+
+    def summary(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+        if len(latencies) == 0:
+            return {'count': 0}
+        return {'count': len(latencies), 'p50_ms': float(np.percentile(latencies, 50)),
+                'p99_ms': float(np.percentile(latencies, 99)), 'mean_ms': float(latencies.mean())}
+
+
+def make_handler(batcher, meter):
+    class Handler(BaseHTTPRequestHandler):
+        # GET /recommend?users=1,2,3&k=20&exclude_seen=1, GET /stats, POST /swap?snap=3
+
+        def _reply(self, code, body):
+            data = json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            if url.path == '/recommend':
+                t0 = time.time()
+                try:
+                    user_ids = [int(u) for u in query['users'][0].split(',')]
+                    k = int(query.get('k', ['20'])[0])
+                    exclude_seen = bool(int(query.get('exclude_seen', ['1'])[0]))
+                except (KeyError, ValueError) as e:
+                    return self._reply(400, {'error': 'Bad request: {}'.format(e)})
+                n_users = batcher.recommender.model.user_num
+                if k <= 0 or any(u < 0 or u >= n_users for u in user_ids):
+                    return self._reply(400, {'error': 'Bad request: k must be positive and user ids in [0, {})'.format(n_users)})
+                try:
+                    snap_idx, lists = batcher.submit(user_ids, k, exclude_seen).result()
+                except Exception as e:
+                    logging.exception('Recommendation failed')
+                    return self._reply(500, {'error': 'Recommendation failed: {}'.format(e)})
+                meter.add(time.time() - t0)
+                self._reply(200, {'snap': snap_idx, 'items': lists})
+            elif url.path == '/stats':
+                self._reply(200, dict(meter.summary(), snap=batcher.recommender.snap_idx))
+            else:
+                self._reply(404, {'error': 'Unknown path: {}'.format(url.path)})
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            if url.path == '/swap':
+                try:
+                    snap_idx = int(parse_qs(url.query)['snap'][0])
+                except (KeyError, ValueError) as e:
+                    return self._reply(400, {'error': 'Bad request: {}'.format(e)})
+                try:
+                    batcher.recommender.swap(snap_idx)
+                except FileNotFoundError:
+                    return self._reply(404, {'error': 'No checkpoint of snapshot {}'.format(snap_idx)})
+                except Exception as e:
+                    logging.exception('Swap failed')
+                    return self._reply(500, {'error': 'Swap failed: {}'.format(e)})
+                self._reply(200, {'snap': snap_idx})
+            else:
+                self._reply(404, {'error': 'Unknown path: {}'.format(url.path)})
+
+        def log_message(self, format, *args):
+            logging.debug(format % args)
+
+    return Handler
+
+
+def serve(recommender, host='127.0.0.1', port=8000, max_batch=256, max_delay=0.002):
+    batcher = MicroBatcher(recommender, max_batch, max_delay)
+    server = ThreadingHTTPServer((host, port), make_handler(batcher, LatencyMeter()))
+    logging.info('Serving recommendations on http://{}:{}'.format(host, port))
+    server.serve_forever()
@@ -0,0 +1,197 @@
+# -*- coding: UTF-8 -*-
+
+import time
+import logging
+from abc import ABC, abstractmethod
+import numpy as np
+import torch
+
+from utils import utils
+
+
+def load_embeddings(model_path, *names):
+    # Embedding tables of a saved checkpoint (e.g., 'i_embeddings.weight' of <model_path>_snap{i}), read once
+    state = utils.read_checkpoint(model_path, map_location=torch.device('cpu'))['model_state_dict']
+    return tuple(state[name].float().numpy() for name in names)
+
+
+def _select_topk(scores, k):
+    # Top-k columns of each row and their scores, best first
+    k = min(k, scores.shape[1])
+    if k <= 0:
+        empty = np.zeros((len(scores), 0), dtype=np.int64)
+        return empty, scores[:, :0]
+    part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    part_scores = np.take_along_axis(scores, part, axis=1)
+    order = np.argsort(-part_scores, axis=1, kind='stable')
+    return np.take_along_axis(part, order, axis=1), np.take_along_axis(part_scores, order, axis=1)
+
+
+def seen_pairs(seen, users):
+    # (row, item) pairs of the interactions of the queried users, gathered from the CSR index without a loop
+    degrees = seen.degrees(users)
+    rows = np.repeat(np.arange(len(users)), degrees)
+    offsets = np.arange(degrees.sum()) - np.repeat(np.cumsum(degrees) - degrees, degrees)
+    return rows, np.asarray(seen.indices[np.repeat(seen.indptr[users], degrees) + offsets], dtype=np.int64)
+
+
+class TopKIndex(ABC):
+    """
+    Top-K retrieval by inner product over an item embedding table (e.g., i_embeddings of BPR).
+    search() returns the top-k items of each user vector and their scores, best first; with `seen`
+    (a UserItemIndex) and the user ids, the items already interacted with by each user are excluded.
+    Rows with less than k retrievable items are padded with item -1 and score -inf.
+    """
+    def __init__(self, item_vectors):
+        self.item_vectors = np.ascontiguousarray(item_vectors, dtype=np.float32)
+        self.n_items = len(self.item_vectors)
+
+    @abstractmethod
+    def search(self, user_vectors, k, users=None, seen=None):
+        pass
+
+    @staticmethod
+    def _check_seen(users, seen):
+        if seen is not None and users is None:
+            raise ValueError('The user ids are required to exclude the seen items')
+
+    @staticmethod
+    def _pad(items, scores, k):
+        if items.shape[1] < k:
+            n_pad = k - items.shape[1]
+            items = np.pad(items, ((0, 0), (0, n_pad)), constant_values=-1)
+            scores = np.pad(scores, ((0, 0), (0, n_pad)), constant_values=-np.inf)
+        items[np.isneginf(scores)] = -1
+        return items, scores
+
+
+class ExactTopK(TopKIndex):
+    """
+    Exact top-K by a blocked matrix product: the user vectors are scored against `block` items at a time
+    and only the running top-k of each user is kept between blocks.
+    """
+    def __init__(self, item_vectors, block=65536):
+        super().__init__(item_vectors)
+        self.block = block
+
+    def search(self, user_vectors, k, users=None, seen=None):
+        self._check_seen(users, seen)
+        user_vectors = np.asarray(user_vectors, dtype=np.float32)
+        if seen is not None:
+            rows, cols = seen_pairs(seen, np.asarray(users, dtype=np.int64))
+
+        best_items = np.zeros((len(user_vectors), 0), dtype=np.int64)
+        best_scores = np.zeros((len(user_vectors), 0), dtype=np.float32)
+        for start in range(0, self.n_items, self.block):
+            end = min(start + self.block, self.n_items)
+            scores = user_vectors @ self.item_vectors[start:end].T
+            if seen is not None:
+                in_block = (cols >= start) & (cols < end)
+                scores[rows[in_block], cols[in_block] - start] = -np.inf
+            items = np.concatenate([best_items, np.broadcast_to(np.arange(start, end), scores.shape)], axis=1)
+            top, best_scores = _select_topk(np.concatenate([best_scores, scores], axis=1), k)
+            best_items = np.take_along_axis(items, top, axis=1)
+        return self._pad(best_items, best_scores, k)
+
+
+class ClusteredTopK(TopKIndex):
+    """
+    Approximate top-K with an inverted file: the items are clustered by k-means on their vectors, and a query
+    scores only the items of the n_probe clusters whose centroids have the largest inner products with it.
+    """
+    def __init__(self, item_vectors, n_clusters=None, n_probe=8, n_iter=10, random_seed=0, block=65536):
+        super().__init__(item_vectors)
+        self.n_clusters = min(self.n_items, n_clusters or max(1, int(np.sqrt(self.n_items))))
+        self.n_probe = min(n_probe, self.n_clusters)
+        self.block = block
+
+        random_state = np.random.RandomState(random_seed)
+        centroids = self.item_vectors[random_state.choice(self.n_items, self.n_clusters, replace=False)].copy()
+        for _ in range(n_iter):
+            assign = self._assign(centroids)
+            order = np.argsort(assign, kind='stable')
+            counts = np.bincount(assign, minlength=self.n_clusters)
+            nonempty = counts > 0
+            # Segment sums of the items sorted by cluster (empty clusters keep their centroid)
+            sums = np.add.reduceat(self.item_vectors[order], (np.cumsum(counts) - counts)[nonempty], axis=0)
+            centroids[nonempty] = sums / counts[nonempty, None]
+        self.centroids = centroids
+
+        # Items of cluster c: list_items[list_ptr[c]:list_ptr[c+1]]
+        assign = self._assign(centroids)
+        self.list_items = np.argsort(assign, kind='stable')
+        self.list_ptr = np.zeros(self.n_clusters + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assign, minlength=self.n_clusters), out=self.list_ptr[1:])
+
+    def _assign(self, centroids):
+        # Nearest centroid (Euclidean) of every item, computed in blocks of items
+        centroid_norms = (centroids ** 2).sum(axis=1)
+        assign = np.empty(self.n_items, dtype=np.int64)
+        for start in range(0, self.n_items, self.block):
+            end = min(start + self.block, self.n_items)
+            assign[start:end] = (centroid_norms[None, :] - 2 * self.item_vectors[start:end] @ centroids.T).argmin(axis=1)
+        return assign
+
+    def search(self, user_vectors, k, users=None, seen=None):
+        self._check_seen(users, seen)
+        user_vectors = np.asarray(user_vectors, dtype=np.float32)
+        probes = _select_topk(user_vectors @ self.centroids.T, self.n_probe)[0]
+
+        items = np.full((len(user_vectors), k), -1, dtype=np.int64)
+        scores = np.full((len(user_vectors), k), -np.inf, dtype=np.float32)
+        for row, probe in enumerate(probes):
+            candidates = np.concatenate([self.list_items[self.list_ptr[c]:self.list_ptr[c+1]] for c in probe])
+            if len(candidates) == 0:
+                # Only empty clusters were probed: the row stays padded
+                continue
+            candidate_scores = self.item_vectors[candidates] @ user_vectors[row]
+            if seen is not None:
+                candidate_scores[seen.contains(users[row], candidates)] = -np.inf
+            top, top_scores = _select_topk(candidate_scores[None, :], k)
+            items[row, :top.shape[1]] = candidates[top[0]]
+            scores[row, :top.shape[1]] = top_scores[0]
+        return self._pad(items, scores, k)
+
+
+BACKENDS = {'exact': ExactTopK, 'ivf': ClusteredTopK}
+
+
+def build_index(backend, item_vectors, **kwargs):
+    if backend not in BACKENDS:
+        raise ValueError('Unknown retrieval backend: {}'.format(backend))
+    return BACKENDS[backend](item_vectors, **kwargs)
+
+
+def recall(items, exact_items):
+    # Fraction of the exact top-k items (excluding padding) retrieved by an approximate search, averaged over the rows
+    found = (items[:, :, None] == exact_items[:, None, :]).any(axis=1) & (exact_items >= 0)
+    return (found.sum(axis=1) / np.maximum((exact_items >= 0).sum(axis=1), 1)).mean()
+
+
+def recall_report(model_path, snap_indices, k, backend, n_queries=1000, random_seed=0, **kwargs):
+    """
+    For the item table of each _snap{i} checkpoint: build time of the index, query time per user of the exact and
+    the given backend, and the recall of the backend against the exact top-k, over a sample of users.
+    """
+    report = []
+    for snap_idx in snap_indices:
+        path = model_path + '_snap{}'.format(snap_idx)
+        item_vectors, user_vectors = load_embeddings(path, 'i_embeddings.weight', 'u_embeddings.weight')
+        random_state = np.random.RandomState(random_seed)
+        queries = user_vectors[random_state.choice(len(user_vectors), min(n_queries, len(user_vectors)), replace=False)]
+
+        t0 = time.time()
+        index = build_index(backend, item_vectors, **kwargs)
+        build_time = time.time() - t0
+        t0 = time.time()
+        exact_items, _ = ExactTopK(item_vectors).search(queries, k)
+        exact_time = (time.time() - t0) / len(queries)
+        t0 = time.time()
+        items, _ = index.search(queries, k)
+        query_time = (time.time() - t0) / len(queries)
+
+        report.append({'snap_idx': snap_idx, 'build_s': build_time, 'exact_ms': exact_time * 1000,
+                       'query_ms': query_time * 1000, 'recall': recall(items, exact_items)})
+        logging.info('snap{}: {} recall@{} {:.4f}, {:.3f} ms/user (exact {:.3f} ms/user), build {:.2f} s'.format(
+            snap_idx, backend, k, report[-1]['recall'], query_time * 1000, exact_time * 1000, build_time))
+    return report
@@ -0,0 +1,159 @@
+# -*- coding: UTF-8 -*-
+
+import os
+import numpy as np
+
+MAX_SAMPLING_ROUNDS = 1000
+
+class UserItemIndex(object):
+    """
+    Compressed-sparse-row index of the items each user interacted with:
+    the (sorted, unique) items of user u are indices[indptr[u]:indptr[u+1]].
+    Saved as two .npy files so that it can be memory-mapped instead of unpickled.
+    """
+    def __init__(self, indptr, indices, path=None):
+        self._indptr = indptr
+        self._indices = indices
+        self.path = path
+        self.n_users = len(self.indptr) - 1
+
+    @classmethod
+    def build(cls, users, items, n_users):
+        users = np.asarray(users, dtype=np.int64)
+        items = np.asarray(items, dtype=np.int64)
+        n_items = int(items.max()) + 1 if len(items) else 1
+        keys = np.unique(users * n_items + items)
+        user_of_key = keys // n_items
+        indptr = np.zeros(n_users + 1, dtype=np.int64)
+        np.cumsum(np.bincount(user_of_key, minlength=n_users), out=indptr[1:])
+        return cls(indptr, (keys % n_items).astype(np.int32))
+
+    @classmethod
+    def load(cls, path):
+        return cls(None, None, path)
+
+    def save(self, path):
+        # Each file is written to a temporary name and then replaced, so that memory maps of a previous version
+        # (e.g., in other processes) stay valid
+        if not os.path.exists(path):
+            os.mkdir(path)
+        for name, array in [('indptr.npy', self.indptr), ('indices.npy', self.indices)]:
+            tmp_file = os.path.join(path, name + '.tmp')
+            with open(tmp_file, 'wb') as f:
+                np.save(f, array)
+            os.replace(tmp_file, os.path.join(path, name))
+        self.path = path
+
+    @property
+    def indptr(self):
+        if self._indptr is None:
+            self._indptr = np.load(os.path.join(self.path, 'indptr.npy'), mmap_mode='r')
+        return self._indptr
+
+    @property
+    def indices(self):
+        if self._indices is None:
+            self._indices = np.load(os.path.join(self.path, 'indices.npy'), mmap_mode='r')
+        return self._indices
+
+    def items_of(self, user):
+        return self.indices[self.indptr[user]:self.indptr[user+1]]
+
+    def degrees(self, users=None):
+        degrees = np.diff(self.indptr)
+        return degrees if users is None else degrees[users]
+
+    def _search(self, users, items):
+        # Position of items[i] in the sorted row of users[i] (where it is or would be inserted) and the row end
+        lo = self.indptr[users]
+        end = self.indptr[users + 1]
+        hi = end.copy()
+        active = lo < hi
+        while active.any():
+            mid = (lo + hi) // 2
+            go_right = active & (self.indices[np.where(active, mid, 0)] < items)
+            lo = np.where(go_right, mid + 1, lo)
+            hi = np.where(active & ~go_right, mid, hi)
+            active = lo < hi
+        return lo, end
+
+    def contains(self, users, items):
+        """
+        Vectorized membership test of (users[i], items[i]) pairs (any broadcastable shapes),
+        by a binary search within each user's sorted row: O(log d) per pair.
+        """
+        users, items = np.broadcast_arrays(np.asarray(users, dtype=np.int64), np.asarray(items))
+        lo, end = self._search(users, items)
+        found = lo < end
+        found[found] = self.indices[lo[found]] == items[found]
+        return found
+
+    def add(self, users, items, n_users=None):
+        """
+        Insert new (user, item) pairs, keeping every row sorted and unique, with one linear pass over the arrays
+        (instead of rebuilding the index from all interactions). Rows are added for new users up to n_users.
+        The arrays are replaced by in-memory ones; save() writes them back.
+        """
+        users = np.asarray(users, dtype=np.int64)
+        items = np.asarray(items, dtype=np.int64)
+        n_users = max(self.n_users, int(users.max()) + 1 if len(users) else 0, n_users or 0)
+        indptr = np.concatenate([self.indptr, np.full(n_users - self.n_users, self.indptr[-1], dtype=np.int64)])
+
+        # New unique pairs in (user, item) order, so that insertions at the same position stay sorted
+        n_items = int(max(items.max() if len(items) else 0, self.indices.max() if len(self.indices) else 0)) + 1
+        keys = np.unique(users * n_items + items)
+        users, items = keys // n_items, keys % n_items
+        lo, end = UserItemIndex(indptr, self.indices)._search(users, items)
+        new = np.ones(len(users), dtype=bool)
+        new[lo < end] = self.indices[lo[lo < end]] != items[lo < end]
+
+        self._indices = np.insert(self.indices, lo[new], items[new].astype(self.indices.dtype))
+        self._indptr = indptr + np.concatenate([[0], np.cumsum(np.bincount(users[new], minlength=n_users))])
+        self.n_users = n_users
+        return int(new.sum())
+
+    def sample_excluded(self, users, num, low=0, high=None, pool=None, random_state=np.random):
+        """
+        Draw `num` distinct items per user that the user has not interacted with, uniformly from [low, high)
+        or from the item array `pool`. All draws are made at once and only the rejected entries are redrawn.
+        """
+        users = np.asarray(users, dtype=np.int64)
+        if pool is not None:
+            pool = np.asarray(pool, dtype=np.int64)
+            low, high = 0, len(pool)
+
+        def draw(size):
+            drawn = random_state.randint(low, high, size=size, dtype=np.int64)
+            return drawn if pool is None else pool[drawn]
+
+        items = draw((len(users), num))
+        rejected = self._reject(users, items)
+        n_rounds = 0
+        while rejected.any():
+            if n_rounds == MAX_SAMPLING_ROUNDS:
+                raise ValueError('Cannot sample {} distinct non-interacted items for some users'.format(num))
+            items[rejected] = draw(rejected.sum())
+            rejected = self._reject(users, items)
+            n_rounds += 1
+        return items
+
+    def _reject(self, users, items):
+        # Items interacted with by the user, or already drawn earlier in the same row
+        clicked = self.contains(users[:, None], items)
+
+        order = np.argsort(items, axis=1, kind='stable')
+        sorted_items = np.take_along_axis(items, order, axis=1)
+        dup_sorted = np.zeros_like(clicked)
+        dup_sorted[:, 1:] = sorted_items[:, 1:] == sorted_items[:, :-1]
+        dup = np.empty_like(dup_sorted)
+        np.put_along_axis(dup, order, dup_sorted, axis=1)
+
+        return clicked | dup
+
+    def __getstate__(self):
+        # A saved index is re-opened lazily (memory-mapped) in the receiving process
+        state = self.__dict__.copy()
+        if self.path is not None:
+            state['_indptr'] = None
+            state['_indices'] = None
+        return state
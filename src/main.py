@@ -2,10 +2,11 @@
 
 import os
 import sys
-import pickle
 import logging
 import argparse
 import torch
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
 
 from helpers import Reader, Runner
 from models import  Model
@@ -32,9 +33,30 @@ def parse_global_args(parser):
                         help='Whether to regenerate intermediate files.')
     parser.add_argument('--dyn_update', type=int, default=0,
                         help='dynamic update strategy.')
+    parser.add_argument('--precision', type=str, default='fp32',
+                        help='Compute precision of training and scoring: fp32, bf16 (autocast, fp32 weights).')
     return parser
 
 
+def init_fulltrain_worker(args_, model_name_, runner_name_):
+    # Process-pool initializer: the globals set in __main__ are not defined in spawned processes
+    global args, model_name, runner_name
+    args, model_name, runner_name = args_, model_name_, runner_name_
+    logging.basicConfig(filename=args.log_file, level=args.verbose)
+    utils.init_worker(args.train_threads, args.random_seed)
+
+
+def fulltrain_snapshot(corpus, idx, n_idx):
+    # Retrain a fresh model on the data up to the snapshot boundary n_idx and save it as _snap{idx}
+    utils.fix_seed(args.random_seed)
+    model = model_name(args, corpus)
+    model.apply(model.init_weights)
+    model.to(model._device)
+    data_dict = {'train': model_name.Dataset(model, args, corpus, 'fulltrain', n_idx)}
+    runner = runner_name(args, corpus)
+    return runner.train(model, data_dict, args, snap_idx=idx)
+
+
 def main():
     logging.info('-' * 45 + ' BEGIN: ' + utils.get_time() + ' ' + '-' * 45)
 
@@ -49,16 +71,22 @@ def main():
 
     # Read data
     # corpus_path = os.path.join(args.path, args.dataset, model_name.reader + '.pkl')
-    corpus_path = os.path.join(args.path, args.dataset, args.suffix, args.s_fname, model_name.reader + '.pkl')
+    corpus_path = os.path.join(args.path, args.dataset, args.suffix, args.s_fname, model_name.reader + '.json')
     
     if not args.regenerate and os.path.exists(corpus_path):
         logging.info('Load corpus from {}'.format(corpus_path))
-        corpus = pickle.load(open(corpus_path, 'rb'))
+        corpus = reader_name.load(corpus_path)
         #logging.info('Corpus loaded')
     else:
         corpus = reader_name(args)
         logging.info('Save corpus to {}'.format(corpus_path))
-        pickle.dump(corpus, open(corpus_path, 'wb'))
+        corpus.save(corpus_path)
+    if args.append_file:
+        corpus.append(args.append_file)
+        logging.info('Save corpus to {}'.format(corpus_path))
+        corpus.save(corpus_path)
+    if args.export_snapshots:
+        corpus.export_snapshot_files()
 
     args.keys = ['train', 'test']
     logging.info('Total instances: {}'.format(corpus.dataset_size))
@@ -73,33 +101,35 @@ def main():
 
     # full-retraining   
     if 'fulltrain' in args.dyn_method:
-        phase = 'fulltrain'
-        time_d = {}
-        for idx, n_idx in enumerate(corpus.snap_boundaries):
-            utils.fix_seed(args.random_seed)
-            model = model_name(args, corpus)
-            model.apply(model.init_weights)
-            model.to(model._device)
-            data_dict['train'] = model_name.Dataset(model, args, corpus, phase, n_idx)
-
-            if os.path.exists(model.model_path+'_snap{}'.format(corpus.n_snapshots-1)):
-                args.train = 0
-
-            if args.train > 0 or force_train:
-                t = runner.train(model, data_dict, args, snap_idx=idx)
-                time_d['period_{}'.format(idx)] = t
-
-            #print('snap_idx: {}'.format(idx))
-        if args.train > 0:
-            with open(args.test_result_file+'_time_test', 'w+') as f:
-                for k, v in time_d.items():
-                    f.writelines('{}\t'.format(k))
-                f.writelines('\n')
-                for k, v in time_d.items():
-                    f.writelines('{:.4f}\t'.format(v))
-                f.writelines('\n')
-                for k, v in time_d.items():
-                    f.writelines('{:.4f}\t'.format(v/60))
+        time_file = args.test_result_file+'_time_test'
+        time_d = utils.read_time_report(time_file) if os.path.exists(time_file) else {}
+
+        # Resume: only the snapshots without a checkpoint are retrained
+        jobs = []
+        if args.train > 0 or force_train:
+            jobs = [(idx, n_idx) for idx, n_idx in enumerate(corpus.snap_boundaries)
+                    if force_train or not os.path.exists(args.model_path+'_snap{}'.format(idx))]
+        logging.info('Snapshots to retrain: {}'.format([idx for idx, _ in jobs]))
+
+        if args.train_workers > 0 and len(jobs) > 0:
+            # Retrains are independent; each process trains one snapshot at a time
+            with ProcessPoolExecutor(args.train_workers, mp_context=mp.get_context('spawn'),
+                                     initializer=init_fulltrain_worker, initargs=(args, model_name, runner_name)) as pool:
+                futures = [pool.submit(fulltrain_snapshot, corpus, idx, n_idx) for idx, n_idx in jobs]
+                for (idx, _), future in zip(jobs, futures):
+                    time_d['period_{}'.format(idx)] = future.result()
+        else:
+            for idx, n_idx in jobs:
+                time_d['period_{}'.format(idx)] = fulltrain_snapshot(corpus, idx, n_idx)
+
+        if len(jobs) > 0:
+            time_d = {k: time_d[k] for k in sorted(time_d, key=lambda k: int(k.split('_')[-1]))}
+            utils.write_time_report(time_file, time_d)
+
+        utils.fix_seed(args.random_seed)
+        model = model_name(args, corpus)
+        model.apply(model.init_weights)
+        model.to(model._device)
     # 'finetune' or 'pretrain'
     else:
         utils.fix_seed(args.random_seed)
@@ -4,19 +4,22 @@ import torch
 import logging
 import os
 import numpy as np
-import copy
-from random import randint
 from torch.utils.data import Dataset as BaseDataset
 from typing import NoReturn, List
 
 from utils import utils
 from helpers.Reader import Reader
 DEFAULT_EPS = 1e-10
+# detNeuralSort computes only the needed rows of the relaxed permutation matrix for k up to this
+FAST_SORT_MAX_K = 32
 
 class Model(torch.nn.Module):
     reader = 'Reader'
     runner = 'Runner'
     extra_log_args = []
+    # Embedding tables indexed by user/item ids that are L2-regularized (row-wise with sparse gradients)
+    user_tables = []
+    item_tables = []
 
     @staticmethod
     def parse_model_args(parser):
@@ -32,6 +35,14 @@ class Model(torch.nn.Module):
                             help='DRM term weight.')
         parser.add_argument('--tau', type=float, default=3.0,
                             help='DRM hyperparameter tau.')
+        parser.add_argument('--attr_col', type=int, default=1,
+                            help='Column of the sensitive attribute in user_attr (MovieLens: 1 gender, 2 age, 3 occupation).')
+        parser.add_argument('--fair_ref', type=int, default=-1,
+                            help='Reference group of the fairness loss (-1: group 0 for binary attributes, else the mean over groups).')
+        parser.add_argument('--sparse_emb', type=int, default=0,
+                            help='Sparse gradients for the embedding tables (updated by SparseAdam, touched rows only).')
+        parser.add_argument('--ckpt_keyframe', type=int, default=0,
+                            help='Save snapshots as row deltas of the previous one, with a full checkpoint every this number of snapshots (0: all full).')
         return parser
 
     @staticmethod
@@ -50,6 +61,9 @@ class Model(torch.nn.Module):
         self.num_neg = args.num_neg
         self.num_neg_fair = args.num_neg_fair
         self.item_num = corpus.n_items
+        self.sparse_emb = bool(args.sparse_emb)
+        self.ckpt_keyframe = args.ckpt_keyframe
+        self._saved_snapshot = None  # (path, CPU state dict) of the last saved snapshot, the base of the next delta
         self.optimizer = None
         self._define_params()
         self.total_parameters = self.count_variables()
@@ -58,14 +72,41 @@ class Model(torch.nn.Module):
         self.DRM = args.DRM
         self.DRM_weight = args.DRM_weight
         self.tau = args.tau
-
-
-    def get_relevances(self, model, user, items):
-        pred_eval = model.model_(user, items, self.DRM)
-
-        return pred_eval.cpu().data.numpy()
+        self.fair_ref = args.fair_ref
+
+
+    def score(self, users, items):
+        """
+        Scores of the users (n_users) for the candidate items (NumPy arrays or tensors), as a tensor on the device:
+        items[i, j] is the j-th candidate of users[i], or a 1-d items array is the candidate list of every user.
+        """
+        u_ids = torch.as_tensor(users, dtype=torch.long, device=self._device).view(-1)
+        i_ids = torch.as_tensor(items, dtype=torch.long, device=self._device)
+        with torch.no_grad():
+            return self._score(u_ids, i_ids)
+
+    def score_all(self, users, item_block=None):
+        """
+        Scores of the users against all items [n_users, n_items], computed for blocks of item_block items at a time
+        so that the intermediate tensors of a forward pass are bounded by n_users x item_block.
+        """
+        item_block = self.item_num if item_block is None else item_block
+        u_ids = torch.as_tensor(users, dtype=torch.long, device=self._device).view(-1)
+        scores = torch.empty(len(u_ids), self.item_num, device=self._device)
+        for start in range(0, self.item_num, item_block):
+            end = min(start + item_block, self.item_num)
+            scores[:, start:end] = self.score(u_ids, torch.arange(start, end, device=self._device))
+        return scores
+
+    def _score(self, u_ids, i_ids):
+        # Generic path through forward (shared candidates are broadcast over the users)
+        if i_ids.dim() == 1:
+            i_ids = i_ids.unsqueeze(0).expand(len(u_ids), -1)
+        return self(u_ids, i_ids, self.DRM)
 
     def detNeuralSort(self, s, tau=1.0, k=1):
+        if k <= FAST_SORT_MAX_K:
+            return self.detNeuralSort_topk(s, tau=tau, k=k)
         su = s.unsqueeze(-1).float()
         n = s.size()[1]
         one = torch.ones((n, 1), dtype=torch.float32, device=self._device)
@@ -80,6 +121,24 @@ class Model(torch.nn.Module):
         P_hat = sm(P_max / tau)
         return P_hat
 
+    def detNeuralSort_topk(self, s, tau=1.0, k=1):
+        # The first k rows of detNeuralSort without the (n x n) pairwise differences:
+        # sum_l |s_j - s_l| = s_j * (n_less - n_greater) - sum_less + sum_greater over the scores strictly
+        # less/greater than s_j, from the prefix sums of the sorted scores (accumulated in double precision)
+        s = s.float()
+        n = s.size()[1]
+        s_ = s.double()
+        sorted_s = s_.sort(dim=-1)[0]
+        prefix = torch.nn.functional.pad(sorted_s.cumsum(-1), (1, 0))
+        n_less = torch.searchsorted(sorted_s.detach(), s_.detach(), right=False)
+        n_less_equal = torch.searchsorted(sorted_s.detach(), s_.detach(), right=True)
+        sum_less = prefix.gather(-1, n_less)
+        sum_greater = prefix[:, -1:] - prefix.gather(-1, n_less_equal)
+        abs_sum = (s_ * (n_less + n_less_equal - n) - sum_less + sum_greater).float()
+        scaling = (n + 1 - 2 * (torch.arange(k, device=s.device) + 1)).float()
+        P_max = s.unsqueeze(1) * scaling[None, :, None] - abs_sum.unsqueeze(1)
+        return torch.softmax(P_max / tau, -1)
+
     def loss(self, predictions, current, data, reduction):
 
         sen_attr = current['attr']
@@ -88,58 +147,81 @@ class Model(torch.nn.Module):
         if reduction == 'mean':
             loss = loss.mean()
 
-        loss_ = 0
-        fl = 0
         if 'none' not in self.DRM:
             _k = 1
-            adv = sen_attr == 0 # Male
-            disadv = sen_attr != 0 # Female
-            fairness_loss = []
-
-            for bool_mask in [adv, disadv]:
-                new_predictions = predictions[bool_mask]
-
-                # If there are only M/F users in the mini-batch
-                if new_predictions.size()[0] == 0:
-                    return loss, loss, None, None
-                p_hat = self.detNeuralSort(new_predictions, tau=self.tau, k=_k)
-                ps = p_hat.sum(1).clamp(0, 1)
-                a = ps[:, :_k]
-                b = ps[:, _k:_k+self.num_neg_fair]
-                loss1 = a.sum(-1)
-                if reduction == 'mean':
-                    loss1 = loss1.mean()
-                fairness_loss.append(loss1)
+            # Probability of the positive item being ranked in the top-_k, averaged per attribute group in one pass
+            # (segment sums over the group ids; users without an attribute go to an extra group that is dropped)
+            p_hat = self.detNeuralSort(predictions, tau=self.tau, k=_k)
+            top = p_hat.sum(1).clamp(0, 1)[:, :_k].sum(-1)
+            n_groups = data.n_groups
+            groups = torch.where(sen_attr >= 0, sen_attr.long(), torch.full_like(sen_attr, n_groups, dtype=torch.long))
+            group_sum = torch.zeros(n_groups + 1, device=top.device, dtype=top.dtype).index_add_(0, groups, top)[:n_groups]
+            group_cnt = torch.bincount(groups, minlength=n_groups + 1)[:n_groups]
+            group_mean = group_sum / group_cnt.clamp(min=1)
+
+            # The reference group (e.g., Male, group 0 of a binary attribute) against each other group, or with more
+            # than two groups each group against the mean over the groups in the batch; a positive diff is an
+            # advantage of the (reference) group, and pairs with a group missing from the batch are masked
+            present = group_cnt > 0
+            if self.fair_ref >= 0 or n_groups == 2:
+                ref = max(self.fair_ref, 0)
+                others = torch.arange(n_groups, device=top.device) != ref
+                diff = (group_mean[ref] - group_mean)[others]
+                valid = present[ref] & present[others]
+                n_valid = valid.sum()
+                pd = torch.where(valid, diff, torch.zeros_like(diff)).sum() / n_valid.clamp(min=1)
+            else:
+                n_present = present.sum()
+                center = torch.where(present, group_mean, torch.zeros_like(group_mean)).sum() / n_present.clamp(min=1)
+                diff = group_mean - center
+                valid = present & (n_present > 1)
+                n_valid = valid.sum()
+                # Reported as the gap between the best and the worst group (the deviations sum to zero)
+                inf = torch.full_like(group_mean, float('inf'))
+                pd = torch.where(present, group_mean, -inf).max() - torch.where(present, group_mean, inf).min()
 
             # Types of loss functions
             if 'log' in self.DRM:
-                diff = fairness_loss[0] - fairness_loss[1]
                 fl = -((-diff).sigmoid()).log()
-
             elif 'absolute' in self.DRM:
-                diff = fairness_loss[0] - fairness_loss[1]
-                #pd = abs(diff+self.correction)
-                pd = abs(diff)
-                fl = -((-pd).sigmoid()).log()
+                fl = -((-abs(diff)).sigmoid()).log()
+            else:
+                return loss, loss, None, None
 
+            # Mean over the valid pairs (no fairness term if there is none in the batch)
+            fl = torch.where(valid, fl, torch.zeros_like(fl)).sum() / n_valid.clamp(min=1)
 
             loss_ = loss
             #lambda_ = self.DRM_weight
             loss = loss + self.DRM_weight * fl
 
-            if fl == 0:
-                fl_return = None
-            else:
-                fl_return = fl * self.DRM_weight
-
-            return loss, loss_, fl_return, diff
+            # Reported as nan (skipped by the loss meter) if there is no valid pair
+            nan = torch.full_like(fl, float('nan'))
+            return loss, loss_, torch.where(n_valid > 0, fl * self.DRM_weight, nan), torch.where(n_valid > 0, pd, nan)
 
         return loss, loss, None, None
 
+    def touched_rows_l2(self, u_ids, i_ids):
+        # 1/2 * squared norm of the regularized embedding rows referenced by the batch (each row once),
+        # i.e., the weight decay of the dense optimizer restricted to the touched rows
+        reg = 0.
+        for names, ids in [(self.user_tables, u_ids), (self.item_tables, i_ids)]:
+            ids = ids.unique()
+            for name in names:
+                reg = reg + getattr(self, name)(ids).pow(2).sum() / 2
+        return reg
+
+    def sparse_parameters(self) -> list:
+        # Weights of the embedding tables with sparse gradients
+        return [m.weight for m in self.modules() if isinstance(m, torch.nn.Embedding) and m.sparse]
+
     def customize_parameters(self) -> list:
-        # customize optimizer settings for different parameters
+        # customize optimizer settings for different parameters (sparse embedding tables are optimized separately)
+        sparse_p = set(id(p) for p in self.sparse_parameters())
         weight_p, bias_p = [], []
         for name, p in filter(lambda x: x[1].requires_grad, self.named_parameters()):
+            if id(p) in sparse_p:
+                continue
             if 'bias' in name:
                 bias_p.append(p)
             else:
@@ -161,6 +243,37 @@ class Model(torch.nn.Module):
                     model_path)
         #logging.info('Save model to ... ' + model_path[50:])
 
+    def save_snapshot(self, snap_idx) -> NoReturn:
+        """
+        Save the _snap{snap_idx} checkpoint. With ckpt_keyframe > 0, only every ckpt_keyframe-th snapshot is saved in
+        full (with the optimizer state); the others keep the embedding rows that changed since the previous snapshot
+        and the other (dense) tensors, and are reconstructed by utils.read_checkpoint.
+        """
+        model_path = self.model_path + '_snap{}'.format(snap_idx)
+        state = {name: value.detach().cpu().clone() for name, value in self.state_dict().items()}
+        if self.ckpt_keyframe <= 0 or snap_idx % self.ckpt_keyframe == 0:
+            self.save_model(model_path)
+            self._saved_snapshot = (model_path, state) if self.ckpt_keyframe > 0 else None
+            return
+
+        base_path = self.model_path + '_snap{}'.format(snap_idx - 1)
+        if self._saved_snapshot is not None and self._saved_snapshot[0] == base_path:
+            base = self._saved_snapshot[1]
+        else:
+            base = utils.read_checkpoint(base_path, map_location=torch.device('cpu'))['model_state_dict']
+
+        tables = set(name + '.weight' for name, m in self.named_modules() if isinstance(m, torch.nn.Embedding))
+        rows, delta = {}, {}
+        for name, value in state.items():
+            if name in tables:
+                rows[name] = (value != base[name]).any(dim=1).nonzero().view(-1)
+                delta[name] = value[rows[name]]
+            else:
+                delta[name] = value
+        utils.check_dir(model_path)
+        torch.save({'delta_of': os.path.basename(base_path), 'rows': rows, 'model_state_dict': delta}, model_path)
+        self._saved_snapshot = (model_path, state)
+
     def save_best_model(self, model_path=None) -> NoReturn:
         if model_path is None:
             model_path = self.model_path
@@ -177,13 +290,17 @@ class Model(torch.nn.Module):
             model_path += add_path
         
         if torch.cuda.is_available():
-            check_point = torch.load(model_path)
+            check_point = utils.read_checkpoint(model_path)
         else:
-            check_point = torch.load(model_path, map_location=torch.device('cpu'))
+            check_point = utils.read_checkpoint(model_path, map_location=torch.device('cpu'))
             
         self.load_state_dict(check_point['model_state_dict'])
         if flag == 0:
-            self.optimizer.load_state_dict(check_point['optimizer_state_dict'])
+            # Delta checkpoints have no optimizer state: the current one is kept
+            if check_point['optimizer_state_dict'] is not None:
+                self.optimizer.load_state_dict(check_point['optimizer_state_dict'])
+            else:
+                logging.info('No optimizer state in the delta checkpoint ' + model_path)
         #logging.info('Load model from ' + model_path)
 
     def count_variables(self) -> int:
@@ -200,10 +317,9 @@ class Model(torch.nn.Module):
             self.corpus = corpus  # reader object reference
             self.phase = phase
             self.train_ratio = args.train_ratio
-            self.mini_batch_path = corpus.mini_batch_path
+            self.store = corpus.interactions
             self.batch_size = args.batch_size
             self.train_boundary = corpus.n_train_batches
-            self.snapshots_path = corpus.snapshots_path
             self.n_snapshots = corpus.n_snapshots
             
             if phase == 'fulltrain':
@@ -218,10 +334,10 @@ class Model(torch.nn.Module):
                 logging.info("fine-tuning: test n_batches: %s" %str(self.n_batches))
                 #assert corpus.n_test == len(self.neg_items), "Neg items not equal"
 
-            user_attr = utils.read_data_from_file_int(corpus.user_attr_path)
-            self.user_attr_dict = {}
-            for user in user_attr:
-                self.user_attr_dict[user[0]] = user[1] # gender M: 1, F: 0
+            # Group id of the sensitive attribute of each user; shared with the DataLoader workers instead of being copied
+            user_attr, self.attr_values = utils.read_user_attr(corpus.user_attr_path, corpus.n_users, args.attr_col)
+            self.user_attr = torch.from_numpy(user_attr).share_memory_()
+            self.n_groups = len(self.attr_values)
             self.DRM = args.DRM
 
         def __len__(self):
@@ -236,18 +352,15 @@ class Model(torch.nn.Module):
             if self.phase == 'test':
                 index += self.train_boundary
 
-            user_id, item_id = torch.load(os.path.join(self.mini_batch_path, str(index)+'.pt')).T
-            neg_items = self._sample_neg_items(index*self.batch_size,
-                                                index*self.batch_size+len(user_id))
+            start, end = self.corpus.batch_rows(index)
+            user_id = torch.from_numpy(self.store.users[start:end].astype(np.int64))
+            item_id = torch.from_numpy(self.store.items[start:end].astype(np.int64))
+            neg_items = self._sample_neg_items(start, end)
             item_id_ = torch.cat((item_id.reshape(-1, 1), neg_items), axis=-1)
             feed_dict = {'user_id': user_id, #(batch_size, )
                             'item_id': item_id_} #(batch_size, 1+neg_items)
 
-            sen_attr = []
-            for user in user_id:
-                sen_attr.append(self.user_attr_dict[user.item()])
-            sen_attr = torch.from_numpy(np.array(sen_attr))
-            feed_dict['attr'] = sen_attr
+            feed_dict['attr'] = self.user_attr[user_id]
 
             return feed_dict
 
@@ -255,18 +368,7 @@ class Model(torch.nn.Module):
             #num_neg = self.model.num_neg
             num_neg = max(self.model.num_neg, self.model.num_neg_fair)
 
-            neg_items = torch.zeros(size=(index_end-index, num_neg), dtype=torch.int64)
-            for idx, user in enumerate(self.corpus.user_list[index:index_end]): # Automatic coverage?
-                user_clicked_set = copy.deepcopy(self.corpus.user_clicked_set[user])
-                # By copying, it may not collide with other process with same user index
-                for neg in range(num_neg):
-                    neg_item = self._randint_w_exclude(user_clicked_set)
-                    neg_items[idx][neg] = neg_item
-                    # Skip below: one neg for train
-                    user_clicked_set = np.append(user_clicked_set, neg_item)
-
-            return neg_items
-
-        def _randint_w_exclude(self, clicked_set):
-            randItem = randint(1, self.corpus.n_items-1)
-            return self._randint_w_exclude(clicked_set) if randItem in clicked_set else randItem
+            users = self.store.users[index:index_end]
+            neg_items = self.corpus.user_index.sample_excluded(users, num_neg, low=1, high=self.corpus.n_items)
+
+            return torch.from_numpy(neg_items)
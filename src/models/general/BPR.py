@@ -1,8 +1,12 @@
 # -*- coding: UTF-8 -*-
 import torch.nn as nn
 from models.Model import Model
+from utils import utils
 
 class BPR(Model):
+    user_tables = ['u_embeddings']
+    item_tables = ['i_embeddings']
+
     @staticmethod
     def parse_model_args(parser):
         parser.add_argument('--emb_size', type=int, default=64,
@@ -15,28 +19,27 @@ class BPR(Model):
         super().__init__(args, corpus)
 
     def _define_params(self):
-        self.u_embeddings = nn.Embedding(self.user_num, self.emb_size)
-        self.i_embeddings = nn.Embedding(self.item_num, self.emb_size)
+        self.u_embeddings = nn.Embedding(self.user_num, self.emb_size, sparse=self.sparse_emb)
+        self.i_embeddings = nn.Embedding(self.item_num, self.emb_size, sparse=self.sparse_emb)
 
     def forward(self, u_ids, i_ids, flag):
         self.check_list = []
         u_ids = u_ids.unsqueeze(-1).repeat((1, i_ids.shape[1]))  # [batch_size, -1]
 
-        cf_u_vectors = self.u_embeddings(u_ids)
-        cf_i_vectors = self.i_embeddings(i_ids)
+        cf_u_vectors, cf_i_vectors = self._cast(self.u_embeddings(u_ids), self.i_embeddings(i_ids))
 
         prediction = (cf_u_vectors * cf_i_vectors).sum(dim=-1)  # [batch_size, -1]
             
         return prediction.view(len(u_ids), -1)
 
-    def model_(self, user, items, flag):
-        user = user.repeat((1, items.shape[0])).squeeze(0)
-
-        cf_u_vectors = self.u_embeddings(user)
-        cf_i_vectors = self.i_embeddings(items)
-
-        prediction = (cf_u_vectors * cf_i_vectors).sum(dim=-1)
-            
-        return prediction
-
-
+    def _cast(self, *vectors):
+        # Autocast does not cast elementwise products: the gathered vectors are cast to its dtype explicitly
+        dtype = utils.autocast_dtype(self._device)
+        return vectors if dtype is None else tuple(v.to(dtype) for v in vectors)
+
+    def _score(self, u_ids, i_ids):
+        # Inner products without gathering the user vector for every candidate
+        cf_u_vectors, cf_i_vectors = self._cast(self.u_embeddings(u_ids), self.i_embeddings(i_ids))
+        if i_ids.dim() == 1:
+            return cf_u_vectors @ cf_i_vectors.t()
+        return (cf_u_vectors.unsqueeze(1) * cf_i_vectors).sum(dim=-1)
@@ -1,10 +1,14 @@
 # -*- coding: UTF-8 -*-
 import torch
 import torch.nn as nn
+from models.Model import Model
 from models.general.BPR import BPR
 
 
 class NCF(BPR):
+    user_tables = ['mf_u_embeddings', 'mlp_u_embeddings']
+    item_tables = ['mf_i_embeddings', 'mlp_i_embeddings']
+
     @staticmethod
     def parse_model_args(parser):
         parser.add_argument('--layers', type=str, default='[64, 64, 64, 64]',
@@ -16,13 +20,14 @@ class NCF(BPR):
     def __init__(self, args, corpus):
         self.layers = eval(args.layers)
         self.dropout = args.dropout
+        self._item_proj = None  # item half of the first MLP layer of every item (evaluation only)
         super().__init__(args, corpus)
 
     def _define_params(self):
-        self.mf_u_embeddings = nn.Embedding(self.user_num, self.emb_size)
-        self.mf_i_embeddings = nn.Embedding(self.item_num, self.emb_size)
-        self.mlp_u_embeddings = nn.Embedding(self.user_num, self.emb_size)
-        self.mlp_i_embeddings = nn.Embedding(self.item_num, self.emb_size)
+        self.mf_u_embeddings = nn.Embedding(self.user_num, self.emb_size, sparse=self.sparse_emb)
+        self.mf_i_embeddings = nn.Embedding(self.item_num, self.emb_size, sparse=self.sparse_emb)
+        self.mlp_u_embeddings = nn.Embedding(self.user_num, self.emb_size, sparse=self.sparse_emb)
+        self.mlp_i_embeddings = nn.Embedding(self.item_num, self.emb_size, sparse=self.sparse_emb)
 
         self.mlp = nn.ModuleList([])
         pre_size = 2 * self.emb_size
@@ -32,58 +37,54 @@ class NCF(BPR):
         self.dropout_layer = nn.Dropout(p=self.dropout)
         self.prediction = nn.Linear(pre_size + self.emb_size, 1, bias=False)
 
-        self.u_bias = nn.Embedding(self.user_num, 1)
-        self.i_bias = nn.Embedding(self.item_num, 1)
+        self.u_bias = nn.Embedding(self.user_num, 1, sparse=self.sparse_emb)
+        self.i_bias = nn.Embedding(self.item_num, 1, sparse=self.sparse_emb)
+
 
+    def _item_side(self, i_ids):
+        # Item half of the first MLP layer; in evaluation it is gathered from a table computed once per checkpoint
+        w_i = self.mlp[0].weight[:, self.emb_size:]
+        if self.training or torch.is_grad_enabled():
+            return self.mlp_i_embeddings(i_ids) @ w_i.t()
+        if self._item_proj is None:
+            with torch.autocast(device_type=self._device.type, enabled=False):
+                self._item_proj = self.mlp_i_embeddings.weight @ w_i.t()
+        return self._item_proj[i_ids]
 
     def forward(self, u_ids, i_ids, flag):
         self.check_list = []
         #u_ids = feed_dict['user_id']  # [batch_size]
         #i_ids = feed_dict['item_id']  # [batch_size, -1]
 
-        u_ids = u_ids.unsqueeze(-1).repeat((1, i_ids.shape[1]))  # [batch_size, -1]
-
-        mf_u_vectors = self.mf_u_embeddings(u_ids)
-        mf_i_vectors = self.mf_i_embeddings(i_ids)
-        mlp_u_vectors = self.mlp_u_embeddings(u_ids)
-        mlp_i_vectors = self.mlp_i_embeddings(i_ids)
+        # Factorized first MLP layer: W [u; i] = W_u u + W_i i, where the user half (and the user MF and bias
+        # vectors) are computed once per row and broadcast over the item columns
+        mf_u_vectors = self.mf_u_embeddings(u_ids).unsqueeze(1)  # [batch_size, 1, emb_size]
+        mf_i_vectors = self.mf_i_embeddings(i_ids)  # [batch_size, -1, emb_size]
+        mlp_u_hidden = self.mlp_u_embeddings(u_ids) @ self.mlp[0].weight[:, :self.emb_size].t()
 
         mf_vector = mf_u_vectors * mf_i_vectors
-        mlp_vector = torch.cat([mlp_u_vectors, mlp_i_vectors], dim=-1)
-        for layer in self.mlp:
+        mlp_vector = (mlp_u_hidden.unsqueeze(1) + self._item_side(i_ids)).relu()
+        mlp_vector = self.dropout_layer(mlp_vector)
+        for layer in self.mlp[1:]:
             mlp_vector = layer(mlp_vector).relu()
             mlp_vector = self.dropout_layer(mlp_vector)
 
         output_vector = torch.cat([mf_vector, mlp_vector], dim=-1)
-        prediction = self.prediction(output_vector)
+        prediction = self.prediction(output_vector).squeeze(-1)
 
-        user_bias = self.u_bias(u_ids).view_as(prediction)
-        item_bias = self.i_bias(i_ids).view_as(prediction)
+        user_bias = self.u_bias(u_ids)  # [batch_size, 1]
+        item_bias = self.i_bias(i_ids).squeeze(-1)
 
         prediction = prediction + user_bias + item_bias
         return prediction.view(len(u_ids), -1)
 
-    def model_(self, u_ids, i_ids, flag):
-        # u_ids = torch.from_numpy(np.array(u_ids))
-        # i_ids = torch.from_numpy(np.array(i_ids))
-        u_ids = u_ids.repeat((1, i_ids.shape[0])).squeeze(0)
+    # Through the factorized forward rather than the inner products of BPR
+    _score = Model._score
 
-        mf_u_vectors = self.mf_u_embeddings(u_ids)
-        mf_i_vectors = self.mf_i_embeddings(i_ids)
-        mlp_u_vectors = self.mlp_u_embeddings(u_ids)
-        mlp_i_vectors = self.mlp_i_embeddings(i_ids)
+    def train(self, mode=True):
+        self._item_proj = None
+        return super().train(mode)
 
-        mf_vector = mf_u_vectors * mf_i_vectors
-        mlp_vector = torch.cat([mlp_u_vectors, mlp_i_vectors], dim=-1)
-        for layer in self.mlp:
-            mlp_vector = layer(mlp_vector).relu()
-            mlp_vector = self.dropout_layer(mlp_vector)
-
-        output_vector = torch.cat([mf_vector, mlp_vector], dim=-1)
-        prediction = self.prediction(output_vector)
-
-        user_bias = self.u_bias(u_ids).view_as(prediction)
-        item_bias = self.i_bias(i_ids).view_as(prediction)
-
-        prediction = prediction + user_bias + item_bias
-        return prediction
\ No newline at end of file
+    def load_model(self, model_path=None, add_path=None, flag=0):
+        self._item_proj = None
+        super().load_model(model_path, add_path, flag)
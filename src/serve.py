@@ -0,0 +1,62 @@
+# -*- coding: UTF-8 -*-
+
+import os
+import sys
+import logging
+import argparse
+
+from helpers import Reader, Runner, Service
+from models import Model
+from models.general import BPR, NCF
+from main import parse_global_args
+
+
+def parse_serve_args(parser):
+    parser.add_argument('--snap', type=int, default=-1,
+                        help='Snapshot checkpoint served at start (-1: the last one).')
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+                        help='Host of the HTTP service.')
+    parser.add_argument('--port', type=int, default=8000,
+                        help='Port of the HTTP service.')
+    parser.add_argument('--max_batch', type=int, default=256,
+                        help='Max. number of users of the requests scored together.')
+    parser.add_argument('--max_delay_ms', type=float, default=2,
+                        help='Max. time a request waits for other requests to be batched with.')
+    parser.add_argument('--cache_size', type=int, default=100000,
+                        help='Number of cached per-user recommendation lists.')
+    parser.add_argument('--item_block', type=int, default=65536,
+                        help='Number of items scored at a time.')
+    return parser
+
+
+if __name__ == '__main__':
+    init_parser = argparse.ArgumentParser(description='Serve')
+    init_parser.add_argument('--model_name', type=str, default='BPR', help='Choose a model to serve.')
+    init_args, init_extras = init_parser.parse_known_args()
+    model_name = eval('{0}.{0}'.format(init_args.model_name))
+    reader_name = eval('{0}.{0}'.format(model_name.reader))
+    runner_name = eval('{0}.{0}'.format(model_name.runner))
+    parser = argparse.ArgumentParser(description='')
+    parser = parse_global_args(parser)
+    parser = reader_name.parse_data_args(parser)
+    parser = runner_name.parse_runner_args(parser)
+    parser = model_name.parse_model_args(parser)
+    parser = parse_serve_args(parser)
+    args, extras = parser.parse_known_args()
+    # --model_path: the checkpoint path without the _snap{i} suffix (as written by main.py)
+    if args.model_path == '':
+        raise ValueError('--model_path of the trained checkpoints is required')
+
+    logging.basicConfig(level=args.verbose)
+    logging.getLogger().addHandler(logging.StreamHandler(sys.stdout))
+    os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu
+
+    args.s_fname = '{}_{}_{}_s{}'.format(args.split_type, args.train_ratio, args.batch_size, args.n_snapshots)
+    corpus_path = os.path.join(args.path, args.dataset, args.suffix, args.s_fname, model_name.reader + '.json')
+    corpus = reader_name.load(corpus_path)
+
+    model = model_name(args, corpus)
+    model.to(model._device)
+    snap_idx = corpus.n_snapshots - 1 if args.snap < 0 else args.snap
+    recommender = Service.Recommender(model, corpus, snap_idx, args.item_block, args.cache_size)
+    Service.serve(recommender, args.host, args.port, args.max_batch, args.max_delay_ms / 1000)
@@ -0,0 +1,84 @@
+# -*- coding: UTF-8 -*-
+"""
+Top-K metrics of all users at once from a (users x K) hit matrix.
+hits[u, j] is True if the j-th recommended item of user u is a test item, n_rec[u] is the length of
+the recommendation list of user u (no hits beyond it) and n_pos[u] is the number of test items of user u.
+"""
+import numpy as np
+
+_discounts = np.zeros(0)
+
+
+def discounts(K):
+    # 1/log2(rank+1) for rank = 1..K, computed once for the largest K seen so far
+    global _discounts
+    if len(_discounts) < K:
+        _discounts = 1. / np.log2(np.arange(2, K + 2))
+    return _discounts[:K]
+
+
+def _safe_divide(a, b):
+    a, b = np.asarray(a, dtype=np.float64), np.asarray(b, dtype=np.float64)
+    return np.divide(a, b, out=np.zeros_like(a), where=b != 0)
+
+
+def recall(hits, n_rec, n_pos):
+    return _safe_divide(hits.sum(1), n_pos)
+
+
+def precision(hits, n_rec, n_pos):
+    return _safe_divide(hits.sum(1), n_rec)
+
+
+def f1(hits, n_rec, n_pos):
+    r, p = recall(hits, n_rec, n_pos), precision(hits, n_rec, n_pos)
+    return _safe_divide(2 * r * p, r + p)
+
+
+def ndcg(hits, n_rec, n_pos):
+    # The ideal list places the same number of hits at its top
+    disc = discounts(hits.shape[1])
+    dcg = hits @ disc
+    idcg = np.concatenate([[0.], np.cumsum(disc)])[hits.sum(1)]
+    return _safe_divide(dcg, idcg)
+
+
+def hit_ratio(hits, n_rec, n_pos):
+    return hits.any(1).astype(np.float64)
+
+
+def mrr(hits, n_rec, n_pos):
+    return hits @ (1. / np.arange(1, hits.shape[1] + 1))
+
+
+def average_precision(hits, n_rec, n_pos):
+    precision_at = np.cumsum(hits, 1) / np.arange(1, hits.shape[1] + 1)
+    return _safe_divide((precision_at * hits).sum(1), hits.sum(1))
+
+
+METRICS = {
+    'recall': recall,
+    'precision': precision,
+    'f1': f1,
+    'ndcg1': ndcg,
+    'hit': hit_ratio,
+    'mrr': mrr,
+    'map': average_precision,
+}
+
+
+def evaluate(metrics, hits, n_rec, n_pos):
+    for metric in metrics:
+        if metric not in METRICS:
+            raise ValueError('Undefined evaluation metric: {}.'.format(metric))
+    return {metric: METRICS[metric](hits, n_rec, n_pos) for metric in metrics}
+
+
+def group_sum(values, groups, n_groups):
+    # Segment sum of the per-user values over group ids in [0, n_groups); other ids are ignored
+    valid = (groups >= 0) & (groups < n_groups)
+    return np.bincount(groups[valid].astype(np.int64), weights=np.asarray(values, dtype=np.float64)[valid], minlength=n_groups)
+
+
+def group_mean(values, groups, n_groups):
+    return _safe_divide(group_sum(values, groups, n_groups), group_sum(np.ones(len(groups)), groups, n_groups))
@@ -25,6 +25,17 @@ def read_data_from_file_int(filename, flag=0):
             data = [str_list_to_int(line.split('::')) for line in lines]
     return data
 
+def read_user_attr(filename, n_users, col=1):
+    # Dense group ids of the attribute in the given column, indexed by user id (-1 for users without an attribute),
+    # and the attribute value of each group id (e.g., MovieLens ages 1, 18, 25, ... -> groups 0, 1, 2, ...)
+    data = np.loadtxt(filename, dtype=np.int64, ndmin=2, usecols=(0, col))
+    data = data[data[:, 0] < n_users]
+    values, groups = np.unique(data[:, 1], return_inverse=True)
+    assert len(values) <= np.iinfo(np.int8).max, 'Too many attribute values for int8 group ids'
+    user_attr = np.full(n_users, -1, dtype=np.int8)
+    user_attr[data[:, 0]] = groups.reshape(-1)
+    return user_attr, values.tolist()
+
 def str_list_to_int(str_list):
     return [int(item) for item in str_list]
 
@@ -62,10 +73,30 @@ def write_interactions_to_file(filename, data):
             f.writelines('{}\t{}\n'.format(d[0],d[1]))
 
 
-def batch_to_gpu(batch: dict, device) -> dict:
+def write_time_report(filename, time_d):
+    # Rows: period names, seconds and minutes (tab-separated)
+    with open(filename, 'w+') as f:
+        for k, v in time_d.items():
+            f.writelines('{}\t'.format(k))
+        f.writelines('\n')
+        for k, v in time_d.items():
+            f.writelines('{:.4f}\t'.format(v))
+        f.writelines('\n')
+        for k, v in time_d.items():
+            f.writelines('{:.4f}\t'.format(v/60))
+
+def read_time_report(filename):
+    with open(filename, 'r') as f:
+        lines = f.readlines()
+    if len(lines) < 2:
+        return {}
+    return dict(zip(lines[0].split(), str_list_to_float(lines[1].split())))
+
+
+def batch_to_gpu(batch: dict, device, non_blocking=False) -> dict:
     for c in batch:
         if type(batch[c]) is torch.Tensor:
-            batch[c] = batch[c].to(device)
+            batch[c] = batch[c].to(device, non_blocking=non_blocking)
     return batch
 
 def squeeze_dict(batch: dict, dim=0) -> dict:
@@ -88,6 +119,39 @@ def fix_seed(seed: int):
     torch.cuda.manual_seed(seed)
     torch.backends.cudnn.deterministic = True
 
+def init_worker(n_threads: int, seed: int):
+    # Process-pool initializer: limit the CPU threads of the worker and fix its random seed
+    torch.set_num_threads(n_threads)
+    fix_seed(seed)
+
+def read_checkpoint(model_path: str, map_location=None) -> dict:
+    # A saved checkpoint; a row-delta checkpoint is applied on the state of its base checkpoint (in the same
+    # directory), which may itself be a delta, up to a full keyframe
+    check_point = torch.load(model_path, map_location=map_location)
+    if 'delta_of' not in check_point:
+        return check_point
+    base = read_checkpoint(os.path.join(os.path.dirname(model_path), check_point['delta_of']), map_location)
+    state = base['model_state_dict']
+    for name, value in check_point['model_state_dict'].items():
+        if name in check_point['rows']:
+            state[name][check_point['rows'][name]] = value.to(state[name].device)
+        else:
+            state[name] = value
+    return {'model_state_dict': state, 'optimizer_state_dict': check_point.get('optimizer_state_dict')}
+
+def autocast(precision: str, device):
+    # Mixed-precision region: bfloat16 compute with the (fp32) weights unchanged; a no-op for fp32
+    if precision not in ('fp32', 'bf16'):
+        raise ValueError('Unknown precision: ' + precision)
+    return torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=precision == 'bf16')
+
+def autocast_dtype(device):
+    # Compute dtype of an enclosing autocast region on the device (None outside of one), for the ops autocast
+    # does not cast by itself (e.g., elementwise products)
+    if device.type == 'cuda':
+        return torch.get_autocast_gpu_dtype() if torch.is_autocast_enabled() else None
+    return torch.get_autocast_cpu_dtype() if torch.is_autocast_cpu_enabled() else None
+
 def get_time():
     return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
@@ -0,0 +1,50 @@
+# -*- coding: UTF-8 -*-
+import os
+import sys
+import types
+
+import pytest
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from models import Model as model_module  # noqa: E402
+
+
+def full_sort(s, tau, k, monkeypatch):
+    # The original (n x n) relaxed sort, forced for any k
+    monkeypatch.setattr(model_module, 'FAST_SORT_MAX_K', -1)
+    stub = types.SimpleNamespace(_device=torch.device('cpu'))
+    return model_module.Model.detNeuralSort(stub, s, tau=tau, k=k)
+
+
+def topk_sort(s, tau, k):
+    stub = types.SimpleNamespace(_device=torch.device('cpu'))
+    return model_module.Model.detNeuralSort_topk(stub, s, tau=tau, k=k)
+
+
+@pytest.mark.parametrize('n, k, tau, ties', [
+    (5, 1, 3.0, False),
+    (5, 5, 1.0, False),
+    (17, 4, 0.5, True),
+    (9, 1, 3.0, True),
+    (300, 1, 3.0, False),
+    (500, 8, 1.0, True),
+])
+def test_topk_matches_full_sort(n, k, tau, ties, monkeypatch):
+    torch.manual_seed(0)
+    s = torch.randn(8, n, dtype=torch.float64)
+    if ties:
+        s = (s * 2).round() / 2  # many equal scores
+    s_full = s.clone().float().requires_grad_()
+    s_topk = s.clone().float().requires_grad_()
+
+    p_full = full_sort(s_full, tau, k, monkeypatch)
+    p_topk = topk_sort(s_topk, tau, k)
+    assert p_topk.shape == p_full.shape == (8, k, n)
+    assert torch.allclose(p_topk, p_full, rtol=1e-4, atol=1e-5)
+
+    # Gradients of a loss of the form used in Model.loss (top-k probability of the first column)
+    weights = torch.randn(8)
+    (p_full.sum(1).clamp(0, 1)[:, 0] * weights).sum().backward()
+    (p_topk.sum(1).clamp(0, 1)[:, 0] * weights).sum().backward()
+    assert torch.allclose(s_topk.grad, s_full.grad, rtol=1e-3, atol=1e-5)